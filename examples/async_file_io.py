@@ -13,8 +13,7 @@ async def main():
         await codebox.aupload("iris.csv", csv_bytes)
 
         # install openpyxl for excel conversion
-        await codebox.ainstall("pandas")
-        await codebox.ainstall("openpyxl")
+        await codebox.ainstall_many(["pandas", "openpyxl"])
 
         # convert dataset csv to excel
         output = await codebox.arun(
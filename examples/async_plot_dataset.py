@@ -17,8 +17,7 @@ async def main():
         await codebox.aupload("iris.csv", csv_bytes)
 
         # install the required packages
-        await codebox.ainstall("matplotlib")
-        await codebox.ainstall("pandas")
+        await codebox.ainstall_many(["matplotlib", "pandas"])
 
         # dataset analysis code
         code = (
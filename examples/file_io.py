@@ -11,8 +11,7 @@ with DockerBox() as codebox:
     codebox.upload("iris.csv", csv_bytes)
 
     # install openpyxl for excel conversion
-    codebox.install("pandas")
-    codebox.install("openpyxl")
+    codebox.install_many(["pandas", "openpyxl"])
 
     # convert dataset csv to excel
     output = codebox.run(
@@ -36,12 +36,10 @@ with DockerBox() as codebox:
             )
             exit(1)
 
-        # Convert the image content ( bytes) into an image
-        import base64
+        # Convert the image content (bytes) into an image
         from io import BytesIO
 
-        img_bytes = base64.b64decode(output.content)
-        img_buffer = BytesIO(img_bytes)
+        img_buffer = BytesIO(output.as_bytes())
 
         # Display the image
         img = Image.open(img_buffer)
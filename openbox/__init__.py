@@ -1,6 +1,15 @@
-from .box import JupyterBox, DockerBox
+from .box import (
+    JupyterBox,
+    DockerBox,
+    DockerBoxPool,
+    SessionReaper,
+    sessions,
+)
 
 __all__ = [
     "JupyterBox",
     "DockerBox",
+    "DockerBoxPool",
+    "SessionReaper",
+    "sessions",
 ]
@@ -1,9 +1,16 @@
 from .base import BaseBox
 from .jupyter import JupyterBox
 from .docker import DockerBox
+from .pool import DockerBoxPool
+from .reaper import SessionReaper
+from .registry import SessionRegistry, sessions
 
 __all__ = [
     "BaseBox",
     "JupyterBox",
     "DockerBox",
+    "DockerBoxPool",
+    "SessionReaper",
+    "SessionRegistry",
+    "sessions",
 ]
@@ -0,0 +1,187 @@
+"""Streaming file transfer helpers.
+
+Docker only accepts and returns files as tar archives. The helpers in here
+produce and consume those archives chunk by chunk and open the supported
+upload sources as file objects, so files of any size are transferred
+without holding them in memory.
+"""
+
+import asyncio
+import io
+import mmap
+import os
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+from os import PathLike
+from typing import (
+    IO,
+    AsyncIterable,
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+CHUNK_SIZE = 1024 * 1024
+
+# sources of unknown size are spooled to disk once they exceed this size
+SPOOL_SIZE = 8 * CHUNK_SIZE
+
+#: A file to put into an archive: its name, size and a readable source.
+ArchiveMember = Tuple[str, int, IO[bytes]]
+
+#: Content to upload: bytes, an mmap, a local path or an iterable of chunks.
+Source = Union[
+    bytes, bytearray, memoryview, mmap.mmap, str, PathLike, Iterable[bytes]
+]
+
+#: Called with the bytes transferred so far and the total size if known.
+Progress = Callable[[int, Optional[int]], None]
+
+
+def tar_stream(
+    members: Iterable[ArchiveMember], chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Yield a tar archive of the members in chunks of at most chunk_size."""
+    for name, size, source in members:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        remaining = size
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValueError(f"{name} is shorter than its size {size}")
+            remaining -= len(chunk)
+            yield chunk
+        if padding := -size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * padding
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore[override]
+        while not self._buffer:
+            chunk: Optional[bytes] = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def untar_stream(
+    chunks: Iterable[bytes], chunk_size: int = CHUNK_SIZE
+) -> Iterator[Tuple[tarfile.TarInfo, Iterator[bytes]]]:
+    """Iterate over the regular files of a streamed tar archive.
+
+    Yields the header of each file together with an iterator over its
+    content, which has to be consumed before advancing to the next file.
+    """
+    reader = io.BufferedReader(ChunkReader(chunks), chunk_size)
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            source = tar.extractfile(info)
+            assert source is not None
+            yield info, iter(lambda: source.read(chunk_size), b"")
+
+
+class ProgressReader(io.RawIOBase):
+    """Wraps a file object and reports the progress of reading it."""
+
+    def __init__(
+        self, source: IO[bytes], total: Optional[int], progress: Progress
+    ) -> None:
+        self._source = source
+        self._total = total
+        self._progress = progress
+        self._done = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore[override]
+        chunk = self._source.read(len(buffer))
+        size = len(chunk)
+        buffer[:size] = chunk
+        self._done += size
+        self._progress(self._done, self._total)
+        return size
+
+
+@contextmanager
+def open_source(
+    source: Source, size: Optional[int] = None
+) -> Iterator[Tuple[int, IO[bytes]]]:
+    """Open upload content as a file object and determine its size.
+
+    Buffers like bytes or an mmap are read in place, local paths are opened
+    for reading. Iterables of chunks are streamed as they are when their
+    size is given, otherwise they are spooled to a temporary file first.
+    """
+    if isinstance(source, bytes):
+        yield len(source), io.BytesIO(source)
+    elif isinstance(source, (bytearray, memoryview, mmap.mmap)):
+        view = memoryview(source).cast("B")
+        chunks = (
+            view[start : start + CHUNK_SIZE]
+            for start in range(0, view.nbytes, CHUNK_SIZE)
+        )
+        yield view.nbytes, io.BufferedReader(ChunkReader(chunks))
+    elif isinstance(source, (str, PathLike)):
+        with open(source, "rb") as f:
+            yield os.fstat(f.fileno()).st_size, f
+    elif size is not None:
+        yield size, io.BufferedReader(ChunkReader(source), CHUNK_SIZE)
+    else:
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            for chunk in source:
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            yield size, spool  # type: ignore[misc]
+
+
+def file_members(files: Mapping[str, Source]) -> Iterator[ArchiveMember]:
+    """Turn files given by name and content into archive members.
+
+    Sources are opened one after the other while the archive is being
+    streamed and closed as soon as their content was read.
+    """
+    for name, content in files.items():
+        with open_source(content) as (size, source):
+            yield name, size, source
+
+
+def sync_chunks(
+    chunks: AsyncIterable[bytes], loop: asyncio.AbstractEventLoop
+) -> Iterator[bytes]:
+    """Iterate over an async iterable of the event loop from a thread."""
+    iterator = chunks.__aiter__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(
+                iterator.__anext__(), loop  # type: ignore[arg-type]
+            ).result()
+        except StopAsyncIteration:
+            return
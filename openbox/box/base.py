@@ -1,13 +1,41 @@
 """Abstract Base Class for Isolated Execution Environments (CodeBox's)"""
 
+import asyncio
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from datetime import datetime
 from os import PathLike
-from typing import List, Optional
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Union,
+)
 from uuid import UUID
 
 from typing_extensions import Self
 
+from openbox.box.archive import (
+    CHUNK_SIZE,
+    Progress,
+    Source,
+    open_source,
+    sync_chunks,
+)
+from openbox.box.kernel import aborted_output
+from openbox.box.packages import (
+    install_message,
+    install_status,
+    installed_code,
+    parse_installed,
+    pip_install_code,
+)
 from openbox.schema import CodeBoxFile, CodeBoxOutput, CodeBoxStatus
 
 
@@ -18,11 +46,30 @@ class BaseBox(ABC):
         """Initialize the CodeBox instance."""
         self.session_id = session_id
         self.last_interaction = datetime.now()
+        self._executions = 0
+        self._executions_lock = threading.Lock()
 
     def _update(self) -> None:
         """Update last interaction time."""
         self.last_interaction = datetime.now()
 
+    @property
+    def busy(self) -> bool:
+        """Whether code is executing in the CodeBox right now."""
+        return self._executions > 0
+
+    @contextmanager
+    def _executing(self) -> Iterator[None]:
+        """Mark the CodeBox as busy while executing code."""
+        with self._executions_lock:
+            self._executions += 1
+        try:
+            yield
+        finally:
+            with self._executions_lock:
+                self._executions -= 1
+            self._update()
+
     @abstractmethod
     def start(self) -> CodeBoxStatus:
         """Startup the CodeBox instance."""
@@ -32,25 +79,97 @@ class BaseBox(ABC):
         """Async Startup the CodeBox instance."""
 
     @abstractmethod
-    def status(self) -> CodeBoxStatus:
-        """Get the current status of the CodeBox instance."""
+    def status(self, refresh: bool = False) -> CodeBoxStatus:
+        """Get the current status of the CodeBox instance.
+
+        May answer from a recently cached status, ``refresh`` forces a check.
+        """
 
     @abstractmethod
-    async def astatus(self) -> CodeBoxStatus:
+    async def astatus(self, refresh: bool = False) -> CodeBoxStatus:
         """Async Get the current status of the CodeBox instance."""
 
     @abstractmethod
     def run(
-        self, code: Optional[str] = None, file_path: Optional[PathLike] = None
+        self,
+        code: Optional[str] = None,
+        file_path: Optional[PathLike] = None,
+        *,
+        timeout: Optional[float] = None,
     ) -> CodeBoxOutput:
-        """Execute python code inside the CodeBox instance."""
+        """Execute python code inside the CodeBox instance.
+
+        The kernel is interrupted when the execution takes longer than
+        ``timeout`` seconds, defaulting to the RUN_TIMEOUT setting, and an
+        output of type ``timeout`` is returned.
+        """
 
     @abstractmethod
     async def arun(
-        self, code: str, file_path: Optional[PathLike] = None
+        self,
+        code: str,
+        file_path: Optional[PathLike] = None,
+        *,
+        timeout: Optional[float] = None,
     ) -> CodeBoxOutput:
         """Async Execute python code inside the CodeBox instance."""
 
+    def run_many(
+        self,
+        codes: Sequence[str],
+        stop_on_error: bool = True,
+        timeout: Optional[float] = None,
+    ) -> List[CodeBoxOutput]:
+        """Execute many pieces of python code in order.
+
+        Returns an output for each code. With ``stop_on_error`` the code
+        after the first failing one is not run and gets an output of type
+        ``aborted``. The timeout applies to each code on its own. Without
+        ``stop_on_error`` CodeBox'es talking to a kernel send all code at
+        once instead of waiting for each output before sending the next.
+        """
+        outputs: List[CodeBoxOutput] = []
+        for code in codes:
+            if stop_on_error and outputs and _failed(outputs[-1]):
+                outputs.append(aborted_output())
+            else:
+                outputs.append(self.run(code, timeout=timeout))
+        return outputs
+
+    async def arun_many(
+        self,
+        codes: Sequence[str],
+        stop_on_error: bool = True,
+        timeout: Optional[float] = None,
+    ) -> List[CodeBoxOutput]:
+        """Async Execute many pieces of python code in order."""
+        outputs: List[CodeBoxOutput] = []
+        for code in codes:
+            if stop_on_error and outputs and _failed(outputs[-1]):
+                outputs.append(aborted_output())
+            else:
+                outputs.append(await self.arun(code, timeout=timeout))
+        return outputs
+
+    def run_stream(
+        self, code: str, *, timeout: Optional[float] = None
+    ) -> Iterator[CodeBoxOutput]:
+        """Execute python code and yield its outputs as they arrive.
+
+        This default runs the code to the end and yields its ``outputs``
+        afterwards, plus the output itself if it has no outputs or the code
+        timed out. Implementations override it to yield while running.
+        """
+        yield from _stream_outputs(self.run(code, timeout=timeout))
+
+    async def arun_stream(
+        self, code: str, *, timeout: Optional[float] = None
+    ) -> AsyncIterator[CodeBoxOutput]:
+        """Async Execute python code and yield its outputs as they arrive."""
+        output = await self.arun(code, timeout=timeout)
+        for event in _stream_outputs(output):
+            yield event
+
     @abstractmethod
     def upload(self, file_name: str, content: bytes) -> CodeBoxStatus:
         """Upload a file as bytes to the CodeBox instance."""
@@ -59,6 +178,53 @@ class BaseBox(ABC):
     async def aupload(self, file_name: str, content: bytes) -> CodeBoxStatus:
         """Async Upload a file as bytes to the CodeBox instance."""
 
+    def upload_many(self, files: Mapping[str, Source]) -> CodeBoxStatus:
+        """Upload many files as bytes, local paths or chunks to the CodeBox."""
+        for file_name, content in files.items():
+            self.upload_stream(file_name, content)
+        return CodeBoxStatus(
+            status=f"{len(files)} files uploaded successfully"
+        )
+
+    async def aupload_many(self, files: Mapping[str, Source]) -> CodeBoxStatus:
+        """Async Upload many files as bytes, local paths or chunks."""
+        return await asyncio.to_thread(self.upload_many, files)
+
+    def upload_stream(
+        self,
+        file_name: str,
+        source: Source,
+        size: Optional[int] = None,
+        progress: Optional[Progress] = None,
+    ) -> CodeBoxStatus:
+        """Upload a file from bytes, an mmap, a local path or chunks.
+
+        Pass the size of an iterable of chunks if known to avoid spooling it
+        to a temporary file first. ``progress`` is called with the number of
+        bytes uploaded so far and the total size. This default reads the
+        content into memory, implementations override it to stream.
+        """
+        with open_source(source, size) as (size, reader):
+            content = reader.read()
+        status = self.upload(file_name, content)
+        if progress is not None:
+            progress(size, size)
+        return status
+
+    async def aupload_stream(
+        self,
+        file_name: str,
+        source: Union[Source, AsyncIterable[bytes]],
+        size: Optional[int] = None,
+        progress: Optional[Progress] = None,
+    ) -> CodeBoxStatus:
+        """Async Upload a file, which can also come from an async iterable."""
+        if isinstance(source, AsyncIterable):
+            source = sync_chunks(source, asyncio.get_running_loop())
+        return await asyncio.to_thread(
+            self.upload_stream, file_name, source, size, progress
+        )
+
     @abstractmethod
     def download(self, file_name: str) -> CodeBoxFile:
         """Download a file as CodeBoxFile schema."""
@@ -67,13 +233,72 @@ class BaseBox(ABC):
     async def adownload(self, file_name: str) -> CodeBoxFile:
         """Async Download a file as CodeBoxFile schema."""
 
-    @abstractmethod
+    def download_stream(
+        self, file_name: str, progress: Optional[Progress] = None
+    ) -> Iterator[bytes]:
+        """Download a file as chunks of bytes.
+
+        ``progress`` is called with the number of bytes downloaded so far and
+        the total size. This default downloads the whole file first,
+        implementations override it to stream.
+        """
+        content = self.download(file_name).content or b""
+        for start in range(0, len(content), CHUNK_SIZE):
+            chunk = content[start : start + CHUNK_SIZE]
+            if progress is not None:
+                progress(start + len(chunk), len(content))
+            yield chunk
+
+    async def adownload_stream(
+        self, file_name: str, progress: Optional[Progress] = None
+    ) -> AsyncIterator[bytes]:
+        """Async Download a file as chunks of bytes."""
+        chunks = self.download_stream(file_name, progress)
+        while (
+            chunk := await asyncio.to_thread(next, chunks, None)
+        ) is not None:
+            yield chunk
+
     def install(self, package_name: str) -> CodeBoxStatus:
         """Install a python package to the venv."""
+        status = self.install_many([package_name])[package_name]
+        return install_message(package_name, status)
 
-    @abstractmethod
     async def ainstall(self, package_name: str) -> CodeBoxStatus:
         """Async Install a python package to the venv."""
+        status = (await self.ainstall_many([package_name]))[package_name]
+        return install_message(package_name, status)
+
+    def install_many(
+        self, packages: Sequence[str]
+    ) -> Dict[str, CodeBoxStatus]:
+        """Install many python packages with a single pip call.
+
+        Packages which are already installed are skipped. Returns the status
+        of every package: ``already installed``, ``installed`` or ``failed``.
+        """
+        installed = parse_installed(self.run(installed_code(packages)))
+        missing = [p for p in packages if not installed.get(p)]
+        now_installed = (
+            parse_installed(self.run(pip_install_code(missing)))
+            if missing
+            else {}
+        )
+        return install_status(packages, installed, now_installed)
+
+    async def ainstall_many(
+        self, packages: Sequence[str]
+    ) -> Dict[str, CodeBoxStatus]:
+        """Async Install many python packages with a single pip call."""
+        output = await self.arun(installed_code(packages))
+        installed = parse_installed(output)
+        missing = [p for p in packages if not installed.get(p)]
+        now_installed = (
+            parse_installed(await self.arun(pip_install_code(missing)))
+            if missing
+            else {}
+        )
+        return install_status(packages, installed, now_installed)
 
     @abstractmethod
     def list_files(self) -> List[CodeBoxFile]:
@@ -84,11 +309,15 @@ class BaseBox(ABC):
         """Async List all available files inside the CodeBox instance."""
 
     @abstractmethod
-    def restart(self) -> CodeBoxStatus:
-        """Restart the jupyter kernel inside the CodeBox instance."""
+    def restart(self, soft: bool = False) -> CodeBoxStatus:
+        """Restart the jupyter kernel inside the CodeBox instance.
+
+        With ``soft`` only the user namespace is cleared, which keeps the
+        interpreter and its imported modules and is much faster.
+        """
 
     @abstractmethod
-    async def arestart(self) -> CodeBoxStatus:
+    async def arestart(self, soft: bool = False) -> CodeBoxStatus:
         """Async Restart the jupyter kernel inside the CodeBox instance."""
 
     @abstractmethod
@@ -118,3 +347,13 @@ class BaseBox(ABC):
 
     def __str__(self) -> str:
         return self.__repr__()
+
+
+def _failed(output: CodeBoxOutput) -> bool:
+    return output.type in ("error", "timeout", "aborted")
+
+
+def _stream_outputs(output: CodeBoxOutput) -> List[CodeBoxOutput]:
+    if not output.outputs or output.type in ("timeout", "aborted"):
+        return [*output.outputs, output]
+    return output.outputs
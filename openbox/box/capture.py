@@ -0,0 +1,98 @@
+"""Bounded capture of the text printed by an execution.
+
+Code printing a huge dataframe would otherwise be buffered completely, only
+to be cut down to a short summary. The capture keeps the head and a ring
+buffer with the tail of the text, everything in between is dropped as soon
+as it arrives. With ``spill`` the full text is written to a temp file.
+"""
+
+import tempfile
+from collections import deque
+from typing import IO, Deque, List, Optional
+
+from openbox.config import settings
+
+TRUNCATED = "[...]\n"
+
+
+class OutputCapture:
+    """Keeps the first ``head`` and last ``tail`` characters of the text.
+
+    Unset sizes default to the OUTPUT_* settings. With ``spill`` all text is
+    also appended to a temp file, whose path is ``log_file``. The file is
+    kept after the execution, it is up to the caller to remove it.
+    """
+
+    def __init__(
+        self,
+        head: Optional[int] = None,
+        tail: Optional[int] = None,
+        spill: Optional[bool] = None,
+    ) -> None:
+        self.head = settings.OUTPUT_HEAD if head is None else head
+        self.tail = settings.OUTPUT_TAIL if tail is None else tail
+        self.spill = settings.OUTPUT_SPILL if spill is None else spill
+        self.size = 0
+        self.log_file: Optional[str] = None
+        self._head: List[str] = []
+        self._head_size = 0
+        self._tail: Deque[str] = deque()
+        self._tail_size = 0
+        self._file: Optional[IO[str]] = None
+
+    @property
+    def truncated(self) -> bool:
+        """Whether text was dropped from the summary."""
+        kept = min(self._tail_size, max(self.tail, 0))
+        return self.size > self._head_size + kept
+
+    def write(self, text: str) -> None:
+        """Capture the next chunk of text."""
+        self.size += len(text)
+        if self.spill:
+            self._spill(text)
+        if self._head_size < self.head:
+            chunk = text[: self.head - self._head_size]
+            self._head.append(chunk)
+            self._head_size += len(chunk)
+            text = text[len(chunk) :]
+        if not text or self.tail <= 0:
+            return
+        if len(text) > self.tail:
+            text = text[-self.tail :]
+        self._tail.append(text)
+        self._tail_size += len(text)
+        # drop the oldest chunks once the remaining ones hold the tail
+        while self._tail_size - len(self._tail[0]) >= self.tail:
+            self._tail_size -= len(self._tail.popleft())
+
+    def summary(self) -> str:
+        """Return the head and tail, separated by a marker if truncated."""
+        head = "".join(self._head)
+        tail = "".join(self._tail)[-self.tail :] if self.tail > 0 else ""
+        if not self.truncated:
+            return head + tail
+        if head and not head.endswith("\n"):
+            head += "\n"
+        return head + TRUNCATED + tail
+
+    def close(self) -> None:
+        """Close the spill file, it is reopened by further writes."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _spill(self, text: str) -> None:
+        if self._file is None:
+            if self.log_file is None:
+                self._file = tempfile.NamedTemporaryFile(
+                    "w",
+                    prefix="codebox-",
+                    suffix=".log",
+                    delete=False,
+                    encoding="utf-8",
+                )
+                self.log_file = self._file.name
+            else:
+                self._file = open(self.log_file, "a", encoding="utf-8")
+        self._file.write(text)
@@ -4,572 +4,503 @@ This is useful for testing and development.c In case you don't put an api_key,
 this is the default CodeBox.
 """
 import asyncio
+import hashlib
 import json
 import os
 import time
 import docker
-from typing import List, Optional, Union
+import posixpath
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Union,
+)
 from uuid import uuid4, UUID
-import aiohttp
-import requests  # type: ignore
-from openbox.websockets.client import WebSocketClientProtocol
-from openbox.websockets.client import connect as ws_connect
-from openbox.websockets.exceptions import ConnectionClosedError
-from openbox.websockets.sync.client import ClientConnection
-from openbox.websockets.sync.client import connect as ws_connect_sync
-
-from openbox.box import BaseBox
+
+from openbox.box.archive import (
+    CHUNK_SIZE,
+    Progress,
+    ProgressReader,
+    Source,
+    file_members,
+    open_source,
+    tar_stream,
+    untar_stream,
+)
+from openbox.box.gateway import GatewayBox
+from openbox.box.limits import (
+    ResourceLimits,
+    limit_events,
+    limit_watcher,
+    read_limit_counters,
+)
+from openbox.box.registry import sessions
+from openbox.box.utils import await_for_gateway, wait_for_gateway
 from openbox.config import settings
-from openbox.schema import CodeBoxFile, CodeBoxOutput, CodeBoxStatus
+from openbox.schema import CodeBoxFile, CodeBoxStatus
+
+if TYPE_CHECKING:
+    from openbox.box.pool import DockerBoxPool, WarmKernel
 
 DOCKER_IMAGE = "codebox"
+WORKING_DIR = "/usr/src/app"
+GATEWAY_PORT = 8888
+PIP_CACHE_PATH = "/root/.cache/pip"
+
+# directory bit of the file mode docker reports for archives (Go's FileMode)
+_GO_MODE_DIR = 1 << 31
+
+
+def run_gateway_container(
+    docker_client: docker.DockerClient,
+    session_id: UUID,
+    image: str = DOCKER_IMAGE,
+    limits: Optional[ResourceLimits] = None,
+) -> docker.models.containers.Container:
+    """Run a kernel gateway container published on an ephemeral host port.
+
+    Docker picks a free host port for the gateway, use published_port to
+    read it back. This avoids scanning for free ports and can't race with
+    other sessions starting at the same time. The container is limited to
+    the given resources, by default to the ones configured in the settings.
+    """
+    if limits is None:
+        limits = ResourceLimits()
+    command = [
+        "jupyter",
+        "kernelgateway",
+        "--KernelGatewayApp.ip=0.0.0.0",
+        f"--KernelGatewayApp.port={GATEWAY_PORT}",
+    ]
+    if settings.VERBOSE:
+        command.append("--debug")
+    return docker_client.containers.run(
+        image,
+        command=command,
+        detach=True,
+        ports={f"{GATEWAY_PORT}/tcp": None},
+        labels={"session_id": str(session_id)},
+        **_pip_cache_options(),
+        **limits.run_options(docker_client),
+    )
+
+
+def _pip_cache_options() -> Dict[str, Any]:
+    """Mount the host pip cache into the container if one is configured."""
+    if not settings.PIP_CACHE_DIR:
+        return {}
+    cache_dir = os.path.abspath(os.path.expanduser(settings.PIP_CACHE_DIR))
+    os.makedirs(cache_dir, exist_ok=True)
+    return {
+        "volumes": {cache_dir: {"bind": PIP_CACHE_PATH, "mode": "rw"}},
+        "environment": {"PIP_CACHE_DIR": PIP_CACHE_PATH},
+    }
+
+
+def package_image_tag(
+    packages: Iterable[str], image: str = DOCKER_IMAGE
+) -> str:
+    """Return the tag of the image derived from image with packages installed.
+
+    The tag only depends on the set of packages, so the same packages in a
+    different order or spelling case map to the same image.
+    """
+    repository, _ = docker.utils.parse_repository_tag(image)
+    key = "\n".join([image, *sorted({p.strip().lower() for p in packages})])
+    return f"{repository}:pkgs-{hashlib.sha256(key.encode()).hexdigest()[:12]}"
+
+
+def resolve_image(
+    docker_client: docker.DockerClient,
+    image: str = DOCKER_IMAGE,
+    packages: Optional[Sequence[str]] = None,
+) -> str:
+    """Return the image derived for packages if committed, else image."""
+    if packages:
+        derived = package_image_tag(packages, image)
+        try:
+            docker_client.images.get(derived)
+            return derived
+        except docker.errors.ImageNotFound:
+            pass
+    return image
+
+
+def build_package_image(
+    docker_client: docker.DockerClient,
+    packages: Sequence[str],
+    image: str = DOCKER_IMAGE,
+) -> bool:
+    """Build the image derived from image with packages installed.
+
+    The packages are installed by pip in a fresh container of image, which
+    is committed as :func:`package_image_tag` and removed. Nothing of a
+    session ends up in the image shared by later sessions and pools.
+    Returns whether pip succeeded, the image is only committed then.
+    """
+    container = docker_client.containers.run(
+        image,
+        command=["pip", "install", "-q", *packages],
+        detach=True,
+        **_pip_cache_options(),
+    )
+    try:
+        if container.wait()["StatusCode"] != 0:
+            if settings.VERBOSE:
+                print(f"Failed to build the package image: {container.logs()}")
+            return False
+        # keep the command of the base image instead of the pip call
+        command = docker_client.images.get(image).attrs["Config"]["Cmd"]
+        repository, tag = docker.utils.parse_repository_tag(
+            package_image_tag(packages, image)
+        )
+        container.commit(
+            repository=repository,
+            tag=tag,
+            changes=[f"CMD {json.dumps(command)}"] if command else None,
+        )
+        return True
+    finally:
+        container.remove(force=True)
+
+
+def published_port(container: docker.models.containers.Container) -> int:
+    """Return the host port docker assigned to the kernel gateway."""
+    container.reload()
+    bindings = container.attrs["NetworkSettings"]["Ports"][
+        f"{GATEWAY_PORT}/tcp"
+    ]
+    return int(bindings[0]["HostPort"])
 
 
-class DockerBox(BaseBox):
+def _all_installed(statuses: Dict[str, CodeBoxStatus]) -> bool:
+    failed = [
+        package
+        for package, status in statuses.items()
+        if str(status) not in ("installed", "already installed")
+    ]
+    if failed and settings.VERBOSE:
+        print(f"Not building the package image, failed to install: {failed}")
+    return not failed
+
+
+class DockerBox(GatewayBox):
     """DockerBox is a CodeBox implementation that
         runs code in a docker container.
 
     This is useful for both prod and testing.
-    """
 
-    _instance: Optional["DockerBox"] = None
-    _jupyter_pids: List[int] = []
+    The resources of the container are limited with the ``mem_limit``,
+    ``cpus``, ``pids_limit`` and ``cpuset_size`` keyword arguments, see
+    :class:`ResourceLimits`. Sessions started from a pool run with the
+    limits of the pool. OOM kills during an execution are reported in the
+    ``events`` of its output. CPU throttling and reaching the pids limit are
+    not reported there, :meth:`limit_counters` reads all limits.
+    """
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-        else:
-            if settings.SHOW_INFO:
-                print("INFO: Using the DockerBox\n")
-        return cls._instance
+    _docker_client: Optional[docker.DockerClient] = None
 
     def __init__(self, /, **kwargs) -> None:
         super().__init__(session_id=kwargs.pop("session_id", None))
-        self.port: int = 8888
-        self.kernel_id: Optional[UUID] = kwargs.pop("kernel_id", None)
-        self.ws: Union[WebSocketClientProtocol, ClientConnection, None] = None
+        self.kernel_id = kwargs.pop("kernel_id", None)
         self.container: Optional[docker.models.containers.Container] = None
-        self.docker_client = docker.from_env()
-        self.aiohttp_session: Optional[aiohttp.ClientSession] = None
+        self.docker_client: docker.DockerClient = (
+            kwargs.pop("docker_client", None) or self._default_docker_client()
+        )
+        self.pool: Optional["DockerBoxPool"] = kwargs.pop("pool", None)
+        self.image: str = kwargs.pop("image", DOCKER_IMAGE)
+        self.packages: List[str] = list(kwargs.pop("packages", None) or [])
+        self.limits = ResourceLimits(
+            mem_limit=kwargs.pop("mem_limit", None),
+            cpus=kwargs.pop("cpus", None),
+            pids_limit=kwargs.pop("pids_limit", None),
+            cpuset_size=kwargs.pop("cpuset_size", None),
+        )
+        self._limit_counters: Dict[str, int] = {}
         self.last_used_time = time.time()
 
-    # destructor
-    def __del__(self):
-        if self.aiohttp_session is not None:
-            loop = asyncio.new_event_loop()
-            loop.run_until_complete(self.aiohttp_session.close())
-            self.aiohttp_session = None
+    @classmethod
+    def _default_docker_client(cls) -> docker.DockerClient:
+        """Return the docker client shared by all sessions."""
+        if cls._docker_client is None:
+            cls._docker_client = docker.from_env()
+        return cls._docker_client
 
     # use function to update the last used time of the
     def use(self):
+        self._update()
+
+    def _update(self) -> None:
+        super()._update()
         self.last_used_time = time.time()
 
     def start(self) -> CodeBoxStatus:
+        started = time.monotonic()
+        while self.pool is not None and (warm := self.pool.checkout()):
+            try:
+                self._adopt(warm)
+                self._connect()
+            except Exception as e:
+                self._drop_warm(warm, e)
+                continue
+            self.time_to_ready = time.monotonic() - started
+            self._install_packages(warm.image)
+            self._watch_limits()
+            self.use()
+            sessions.register(self)
+            return CodeBoxStatus(status="started")
+
         self.session_id = uuid4()
-        os.makedirs(".codebox", exist_ok=True)
-        self._check_port()
+        self.kernel_id = None
 
         if settings.VERBOSE:
             print("Starting kernel...")
 
         try:
-            self.container = self.docker_client.containers.run(
-                DOCKER_IMAGE,
-                command=[
-                    "jupyter",
-                    "kernelgateway",
-                    "--KernelGatewayApp.ip=0.0.0.0",
-                    f"--KernelGatewayApp.port={self.port}",
-                    "--debug",
-                ],
-                detach=True,
-                ports={f"{self.port}/tcp": self.port},
-                labels={"session_id": str(self.session_id)},
-            )
-
+            image = self._run_container()
         except docker.errors.ContainerError as e:
             print(f"Failed to start container: {e}")
             return CodeBoxStatus(status="error")
 
-        while True:
-            try:
-                response = requests.get(self.kernel_url, timeout=270)
-                if response.status_code == 200:
-                    break
-            except requests.exceptions.ConnectionError:
-                pass
-            if settings.VERBOSE:
-                print("Waiting for kernel to start...")
-            time.sleep(1)
+        try:
+            wait_for_gateway(
+                self.kernel_url,
+                is_alive=self._container_alive,
+                session=self.http_session,
+            )
+        except Exception:
+            self._remove_container(force=True)
+            raise
 
         self._connect()
+        self.time_to_ready = time.monotonic() - started
+        self._install_packages(image)
+        self._watch_limits()
+        self.use()
+        sessions.register(self)
         return CodeBoxStatus(status="started")
 
-    def _connect(self) -> None:
-        if not self.kernel_id:
-            response = requests.post(
-                f"{self.kernel_url}/kernels",
-                headers={"Content-Type": "application/json"},
-                timeout=270,
-            )
-            self.kernel_id = response.json()["id"]
-
-        if self.kernel_id is None:
-            raise Exception("Could not start kernel")
+    def _run_container(self) -> str:
+        """Run the container of a cold start and return its image.
 
-        self.ws = ws_connect_sync(
-            f"{self.ws_url}/kernels/{self.kernel_id}/channels"
+        Blocks on the docker API, run it in a thread from coroutines.
+        """
+        assert self.session_id is not None
+        image = resolve_image(self.docker_client, self.image, self.packages)
+        self.container = run_gateway_container(
+            self.docker_client, self.session_id, image, self.limits
         )
+        try:
+            self.port = published_port(self.container)
+        except Exception:
+            self._remove_container(force=True)
+            raise
+        return image
+
+    def _remove_container(self, force: bool = False) -> None:
+        """Stop and remove the container of the box if it has one."""
+        if self.container is not None:
+            if not force:
+                self.container.stop()
+            self.container.remove(force=force)
+            if self.limits:
+                limit_watcher(self.docker_client).forget(self.container.id)
+            self.container = None
 
-    def _check_port(self) -> int:
-        max_port_limit = 65535
-        initial_port = self.port
+    def _container_alive(self) -> bool:
+        """Check if the container is still starting or running."""
+        if self.container is None:
+            return False
+        self.container.reload()
+        return self.container.status in ("created", "running")
+
+    def _adopt(self, warm: "WarmKernel") -> None:
+        """Take over a warm container checked out of the pool."""
+        self.session_id = warm.session_id
+        self.container = warm.container
+        self.port = warm.port
+        self.kernel_id = warm.kernel_id
+        if self.pool is not None:
+            self.limits = self.pool.limits
+
+    def _drop_warm(self, warm: "WarmKernel", error: Exception) -> None:
+        """Discard a warm container whose kernel can't be reached."""
+        if settings.VERBOSE:
+            print(f"Discarding warm container {warm.session_id}: {error}")
+        self.container = None
+        self.kernel_id = None
+        assert self.pool is not None
+        self.pool.discard(warm)
 
-        while True:
-            print(f"Checking port {self.port}...")
+    async def astart(self) -> CodeBoxStatus:
+        started = time.monotonic()
+        while self.pool is not None and (warm := self.pool.checkout()):
             try:
-                response = requests.get(
-                    f"http://localhost:{self.port}", timeout=5
-                )
-                print(f"Received status code: {response.status_code}")
-            except (
-                requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout,
-            ):
-                print(f"Port {self.port} is free.")
-                return self.port
-            else:
-                print(f"Port {self.port} is occupied. Incrementing...")
-                self.port += 1
-                if self.port > max_port_limit:
-                    self.port = initial_port
-                    raise ValueError("Could not find an available port")
+                self._adopt(warm)
+                await self._aconnect()
+            except Exception as e:
+                await asyncio.to_thread(self._drop_warm, warm, e)
+                continue
+            self.time_to_ready = time.monotonic() - started
+            await self._ainstall_packages(warm.image)
+            await asyncio.to_thread(self._watch_limits)
+            self.use()
+            sessions.register(self)
+            return CodeBoxStatus(status="started")
 
-    async def astart(self) -> CodeBoxStatus:
         self.session_id = uuid4()
-        os.makedirs(".codebox", exist_ok=True)
-        await self._acheck_port()
+        self.kernel_id = None
         if settings.VERBOSE:
             print("Starting kernel asynchronously...")
 
         try:
-            loop = asyncio.get_event_loop()
-            self.container = await loop.run_in_executor(
-                None,
-                lambda: self.docker_client.containers.run(
-                    DOCKER_IMAGE,
-                    detach=True,
-                    ports={f"{self.port}/tcp": self.port},
-                    environment=["KernelGatewayApp.ip='0.0.0.0'"],
-                    labels={"session_id": str(self.session_id)},
-                ),
-            )
+            image = await asyncio.to_thread(self._run_container)
         except docker.errors.ContainerError as e:
             print(f"Failed to start container: {e}")
             return CodeBoxStatus(status="error")
 
-        time.sleep(2)
-        self.aiohttp_session = aiohttp.ClientSession()
-        while True:
-            try:
-                response = await self.aiohttp_session.get(self.kernel_url)
-                if response.status == 200:
-                    break
-            except aiohttp.ClientConnectorError:
-                pass
-            if settings.VERBOSE:
-                print("Waiting for kernel to start...")
-            await asyncio.sleep(1)
+        try:
+            await await_for_gateway(
+                self.kernel_url,
+                self._aiohttp(),
+                is_alive=lambda: asyncio.to_thread(self._container_alive),
+            )
+        except Exception:
+            await asyncio.to_thread(self._remove_container, force=True)
+            raise
 
         await self._aconnect()
+        self.time_to_ready = time.monotonic() - started
+        await self._ainstall_packages(image)
+        await asyncio.to_thread(self._watch_limits)
+        self.use()
+        sessions.register(self)
         return CodeBoxStatus(status="started")
 
-    async def _aconnect(self) -> None:
-        if self.aiohttp_session is None:
-            self.aiohttp_session = aiohttp.ClientSession()
-        response = await self.aiohttp_session.post(
-            f"{self.kernel_url}/kernels",
-            headers={"Content-Type": "application/json"},
-        )
-        self.kernel_id = (await response.json())["id"]
-        if self.kernel_id is None:
-            raise Exception("Could not start kernel")
-        self.ws = await ws_connect(
-            f"{self.ws_url}/kernels/{self.kernel_id}/channels"
-        )
-
-    async def _acheck_port(self) -> None:
-        try:
-            if self.aiohttp_session is None:
-                self.aiohttp_session = aiohttp.ClientSession()
-            response = await self.aiohttp_session.get(
-                f"http://localhost:{self.port}"
-            )
-        except aiohttp.ClientConnectorError:
-            pass
-        except aiohttp.ServerDisconnectedError:
-            pass
-        else:
-            if response.status == 200:
-                self.port += 1
-                await self._acheck_port()
-
-    def status(self) -> CodeBoxStatus:
-        if not self.kernel_id:
-            self._connect()
+    def upload(self, file_name: str, content: bytes) -> CodeBoxStatus:
+        return self.upload_stream(file_name, content)
 
-        self.use()
-        return CodeBoxStatus(
-            status="running"
-            if self.kernel_id
-            and requests.get(self.kernel_url, timeout=270).status_code == 200
-            else "stopped"
-        )
+    async def aupload(self, file_name: str, content: bytes) -> CodeBoxStatus:
+        return await asyncio.to_thread(self.upload, file_name, content)
 
-    async def astatus(self) -> CodeBoxStatus:
-        if not self.kernel_id:
-            await self._aconnect()
+    def upload_many(self, files: Mapping[str, Source]) -> CodeBoxStatus:
+        """Upload many files into the container with one tar archive."""
         self.use()
+        self._put_archive(tar_stream(file_members(files)))
         return CodeBoxStatus(
-            status="running"
-            if self.kernel_id
-            and self.aiohttp_session
-            and (await self.aiohttp_session.get(self.kernel_url)).status == 200
-            else "stopped"
+            status=f"{len(files)} files uploaded successfully"
         )
 
-    def run(
+    def upload_stream(
         self,
-        code: Optional[str] = None,
-        file_path: Optional[os.PathLike] = None,
-        retry=3,
-    ) -> CodeBoxOutput:
-        self.use()
-        if not code and not file_path:
-            raise ValueError("Code or file_path must be specified!")
-
-        if code and file_path:
-            raise ValueError("Can only specify code or the file to read_from!")
-
-        if file_path:
-            with open(file_path, "r", encoding="utf-8") as f:
-                code = f.read()
-
-        # run code in jupyter kernel
-        if retry <= 0:
-            raise RuntimeError("Could not connect to kernel")
-        if not self.ws:
-            self._connect()
-            if not self.ws:
-                raise RuntimeError(
-                    "Jupyter not running. Make sure to start it first."
-                )
-
-        if settings.VERBOSE:
-            print("Running code:\n", code)
-
-        # send code to kernel
-        self.ws.send(
-            json.dumps(
-                {
-                    "header": {
-                        "msg_id": (msg_id := uuid4().hex),
-                        "msg_type": "execute_request",
-                    },
-                    "parent_header": {},
-                    "metadata": {},
-                    "content": {
-                        "code": code,
-                        "silent": False,
-                        "store_history": True,
-                        "user_expressions": {},
-                        "allow_stdin": False,
-                        "stop_on_error": True,
-                    },
-                    "channel": "shell",
-                    "buffers": [],
-                }
-            )
-        )
+        file_name: str,
+        source: Source,
+        size: Optional[int] = None,
+        progress: Optional[Progress] = None,
+    ) -> CodeBoxStatus:
         self.use()
-        result = ""
-        while True:
-            try:
-                if isinstance(self.ws, WebSocketClientProtocol):
-                    raise RuntimeError(
-                        "Mixing asyncio and sync code is not supported"
-                    )
-                received_msg = json.loads(self.ws.recv())
-            except ConnectionClosedError:
-                self.start()
-                return self.run(code, file_path, retry - 1)
-
-            if (
-                received_msg["header"]["msg_type"] == "stream"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                msg = received_msg["content"]["text"].strip()
-                if "Requirement already satisfied:" in msg:
-                    continue
-                result += msg + "\n"
-                if settings.VERBOSE:
-                    print("Output:\n", result)
-
-            elif (
-                received_msg["header"]["msg_type"] == "execute_result"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                result += (
-                    received_msg["content"]["data"]["text/plain"].strip()
-                    + "\n"
-                )
-                if settings.VERBOSE:
-                    print("Output:\n", result)
-
-            elif received_msg["header"]["msg_type"] == "display_data":
-                if "image/png" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="image/png",
-                        content=received_msg["content"]["data"]["image/png"],
-                    )
-                if "text/plain" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="text",
-                        content=received_msg["content"]["data"]["text/plain"],
-                    )
-                return CodeBoxOutput(
-                    type="error",
-                    content="Could not parse output",
-                )
-            elif (
-                received_msg["header"]["msg_type"] == "status"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-                and received_msg["content"]["execution_state"] == "idle"
-            ):
-                if len(result) > 500:
-                    result = "[...]\n" + result[-500:]
-                return CodeBoxOutput(
-                    type="text",
-                    content=result or "code run successfully (no output)",
-                )
-
-            elif (
-                received_msg["header"]["msg_type"] == "error"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                error = (
-                    f"{received_msg['content']['ename']}: "
-                    f"{received_msg['content']['evalue']}"
-                )
-                if settings.VERBOSE:
-                    print("Error:\n", error)
-                return CodeBoxOutput(type="error", content=error)
-
-    async def arun(
-        self,
-        code: str,
-        file_path: Optional[os.PathLike] = None,
-        retry=3,
-    ) -> CodeBoxOutput:
-        self.use()
-        if file_path:
-            raise NotImplementedError(
-                "Reading from file is not supported in async mode"
-            )
-
-        # run code in jupyter kernel
-        if retry <= 0:
-            raise RuntimeError("Could not connect to kernel")
-        if not self.ws:
-            await self._aconnect()
-            if not self.ws:
-                raise RuntimeError(
-                    "Jupyter not running. Make sure to start it first."
-                )
-
-        if settings.VERBOSE:
-            print("Running code:\n", code)
-
-        if not isinstance(self.ws, WebSocketClientProtocol):
-            raise RuntimeError("Mixing asyncio and sync code is not supported")
-
-        await self.ws.send(
-            json.dumps(
-                {
-                    "header": {
-                        "msg_id": (msg_id := uuid4().hex),
-                        "msg_type": "execute_request",
-                    },
-                    "parent_header": {},
-                    "metadata": {},
-                    "content": {
-                        "code": code,
-                        "silent": False,
-                        "store_history": True,
-                        "user_expressions": {},
-                        "allow_stdin": False,
-                        "stop_on_error": True,
-                    },
-                    "channel": "shell",
-                    "buffers": [],
-                }
-            )
-        )
-        self.use()
-        result = ""
-        while True:
-            try:
-                received_msg = json.loads(await self.ws.recv())
-            except ConnectionClosedError:
-                await self.astart()
-                return await self.arun(code, file_path, retry - 1)
-
-            if (
-                received_msg["header"]["msg_type"] == "stream"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                msg = received_msg["content"]["text"].strip()
-                if "Requirement already satisfied:" in msg:
-                    continue
-                result += msg + "\n"
-                if settings.VERBOSE:
-                    print("Output:\n", result)
-
-            elif (
-                received_msg["header"]["msg_type"] == "execute_result"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                result += (
-                    received_msg["content"]["data"]["text/plain"].strip()
-                    + "\n"
-                )
-                if settings.VERBOSE:
-                    print("Output:\n", result)
-
-            elif received_msg["header"]["msg_type"] == "display_data":
-                if "image/png" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="image/png",
-                        content=received_msg["content"]["data"]["image/png"],
-                    )
-                if "text/plain" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="text",
-                        content=received_msg["content"]["data"]["text/plain"],
-                    )
-            elif (
-                received_msg["header"]["msg_type"] == "status"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-                and received_msg["content"]["execution_state"] == "idle"
-            ):
-                if len(result) > 500:
-                    result = "[...]\n" + result[-500:]
-                return CodeBoxOutput(
-                    type="text",
-                    content=result or "code run successfully (no output)",
-                )
-
-            elif (
-                received_msg["header"]["msg_type"] == "error"
-                and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                error = (
-                    f"{received_msg['content']['ename']}: "
-                    f"{received_msg['content']['evalue']}"
-                )
-                if settings.VERBOSE:
-                    print("Error:\n", error)
-                return CodeBoxOutput(type="error", content=error)
-
-    def upload(self, file_name: str, content: bytes) -> CodeBoxStatus:
-        os.makedirs(".codebox", exist_ok=True)
-        with open(os.path.join(".codebox", file_name), "wb") as f:
-            f.write(content)
-
+        with open_source(source, size) as (size, reader):
+            if progress is not None:
+                reader = ProgressReader(reader, size, progress)
+            self._put_archive(tar_stream([(file_name, size, reader)]))
         return CodeBoxStatus(status=f"{file_name} uploaded successfully")
 
-    async def aupload(self, file_name: str, content: bytes) -> CodeBoxStatus:
-        return await asyncio.to_thread(self.upload, file_name, content)
-
     def download(self, file_name: str) -> CodeBoxFile:
-        with open(os.path.join(".codebox", file_name), "rb") as f:
-            content = f.read()
-
-        return CodeBoxFile(name=file_name, content=content)
+        return CodeBoxFile(
+            name=file_name, content=b"".join(self.download_stream(file_name))
+        )
 
     async def adownload(self, file_name: str) -> CodeBoxFile:
         return await asyncio.to_thread(self.download, file_name)
 
-    def install(self, package_name: str) -> CodeBoxStatus:
-        self.run(f"!pip install -q {package_name}")
-        self.restart()
-        self.run(f"try:\n    import {package_name}\nexcept:\n    pass")
-        return CodeBoxStatus(status=f"{package_name} installed successfully")
+    def download_stream(
+        self, file_name: str, progress: Optional[Progress] = None
+    ) -> Iterator[bytes]:
+        self.use()
+        for info, content in untar_stream(self._get_archive(file_name)):
+            downloaded = 0
+            for chunk in content:
+                downloaded += len(chunk)
+                if progress is not None:
+                    progress(downloaded, info.size)
+                yield chunk
+            return
+        raise FileNotFoundError(file_name)
+
+    def install_many(
+        self, packages: Sequence[str], commit: bool = False
+    ) -> Dict[str, CodeBoxStatus]:
+        """Install many python packages with a single pip call.
+
+        With ``commit`` the image derived for these packages is built
+        afterwards with :func:`build_package_image`, which DockerBox and
+        DockerBoxPool start from when given the same packages. The image is
+        only built if all packages are installed, check the returned
+        statuses for the ones which failed.
+        """
+        statuses = super().install_many(packages)
+        if commit and _all_installed(statuses):
+            build_package_image(self.docker_client, packages, self.image)
+        return statuses
+
+    async def ainstall_many(
+        self, packages: Sequence[str], commit: bool = False
+    ) -> Dict[str, CodeBoxStatus]:
+        statuses = await super().ainstall_many(packages)
+        if commit and _all_installed(statuses):
+            await asyncio.to_thread(
+                build_package_image, self.docker_client, packages, self.image
+            )
+        return statuses
+
+    def _needs_packages(self, image: str) -> bool:
+        """Check if the session packages are missing from the image."""
+        return bool(self.packages) and image != package_image_tag(
+            self.packages, self.image
+        )
+
+    def _install_packages(self, image: str) -> None:
+        if self._needs_packages(image):
+            self.install_many(self.packages, commit=True)
 
-    async def ainstall(self, package_name: str) -> CodeBoxStatus:
-        await self.arun(f"!pip install -q {package_name}")
-        await self.arestart()
-        await self.arun(f"try:\n    import {package_name}\nexcept:\n    pass")
-        return CodeBoxStatus(status=f"{package_name} installed successfully")
+    async def _ainstall_packages(self, image: str) -> None:
+        if self._needs_packages(image):
+            await self.ainstall_many(self.packages, commit=True)
 
     def list_files(self) -> List[CodeBoxFile]:
+        self.use()
+        result = self._running_container().exec_run(
+            ["ls", "-1A"], workdir=WORKING_DIR
+        )
+        if result.exit_code != 0:
+            raise RuntimeError(result.output.decode(errors="replace"))
         return [
             CodeBoxFile(name=file_name, content=None)
-            for file_name in os.listdir(".codebox")
+            for file_name in result.output.decode().splitlines()
         ]
 
     async def alist_files(self) -> List[CodeBoxFile]:
         return await asyncio.to_thread(self.list_files)
 
-    def restart(self) -> CodeBoxStatus:
-        self.use()
-        return CodeBoxStatus(status="restarted")
-
-    async def arestart(self) -> CodeBoxStatus:
-        self.use()
-        return CodeBoxStatus(status="restarted")
-
     def stop(self) -> CodeBoxStatus:
-        if self.container is not None:
-            self.container.stop()
-            self.container.remove()
-            self.container = None
-
-        if self.ws is not None:
-            try:
-                if isinstance(self.ws, ClientConnection):
-                    self.ws.close()
-                else:
-                    loop = asyncio.new_event_loop()
-                    loop.run_until_complete(self.ws.close())
-            except ConnectionClosedError:
-                pass
-            self.ws = None
-
-        return CodeBoxStatus(status="stopped")
-
+        with self._lock:
+            sessions.unregister(self)
+            self._disconnect()
+            self._remove_container()
         return CodeBoxStatus(status="stopped")
 
     async def astop(self) -> CodeBoxStatus:
         print(f"Stopping {self.session_id}")
-
-        if self.container is not None:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: self.container.stop())
-            await loop.run_in_executor(None, lambda: self.container.remove())
-            self.container = None
-
-        if self.ws is not None:
-            try:
-                await self.ws.close()
-            except ConnectionClosedError:
-                pass
-            self.ws = None
-
-        if self.aiohttp_session:
-            await self.aiohttp_session.close()
-            self.aiohttp_session = None
-
+        sessions.unregister(self)
+        await self._adisconnect()
+        await asyncio.to_thread(self._remove_container)
         return CodeBoxStatus(status="stopped")
 
     @classmethod
@@ -577,7 +508,7 @@ class DockerBox(BaseBox):
         cls,
         session_id: Union[int, UUID],
         kernel_id: Optional[UUID],
-        port: int,
+        port: Optional[int] = None,
         **kwargs,
     ) -> "DockerBox":
         if kernel_id:
@@ -591,13 +522,14 @@ class DockerBox(BaseBox):
             UUID(int=session_id) if isinstance(session_id, int) else session_id
         )
 
+        if isinstance(running := sessions.get(kwargs["session_id"]), cls):
+            return running
+
         print(f"Kwargs: {kwargs}")
 
         instance = cls(**kwargs)
 
-        instance.port = port
-
-        container_list = docker.from_env().containers.list(
+        container_list = instance.docker_client.containers.list(
             filters={"label": f"session_id={kwargs['session_id']}"}
         )
 
@@ -608,12 +540,69 @@ class DockerBox(BaseBox):
                 f"No container found for session_id {kwargs['session_id']}"
             )
 
+        instance.port = port or published_port(instance.container)
+
+        sessions.register(instance)
         return instance
 
-    @property
-    def kernel_url(self) -> str:
-        """Return the url of the kernel."""
-        return f"http://localhost:{self.port}/api"
+    def _output_events(self) -> List[str]:
+        return self._limit_events()
+
+    def limit_counters(self) -> Dict[str, int]:
+        """Read how often each resource limit of the container was hit.
+
+        Unlike the ``events`` of the outputs, which only report OOM kills,
+        this includes CPU throttling and the pids limit. Docker has no
+        events for these, reading them takes a command in the container, so
+        it is not done for every execution.
+        """
+        return read_limit_counters(self._running_container())
+
+    def _watch_limits(self) -> None:
+        """Follow the limit events and take the counters as the baseline.
+
+        Blocks on the docker API when the events stream has to be followed
+        first, so it is only done on start.
+        """
+        if self.limits:
+            limit_watcher(self.docker_client).start()
+        self._limit_events()
+
+    def _limit_events(self) -> List[str]:
+        """Return the resource limits hit since the last call.
+
+        Only looks up the counters of the docker events stream followed
+        since the start, it doesn't ask docker itself and never blocks.
+        """
+        if not self.limits or self.container is None:
+            return []
+        watcher = limit_watcher(self.docker_client)
+        counters = watcher.counters(self.container.id)
+        events = limit_events(self._limit_counters, counters)
+        self._limit_counters = counters
+        return events
+
+    def _running_container(self) -> docker.models.containers.Container:
+        if self.container is None:
+            raise RuntimeError("The DockerBox has not been started")
+        return self.container
+
+    def _put_archive(self, chunks: Iterator[bytes]) -> None:
+        """Extract a streamed tar archive into the working directory."""
+        if not self._running_container().put_archive(WORKING_DIR, chunks):
+            raise RuntimeError("Failed to upload files to the container")
+
+    def _get_archive(self, file_name: str) -> Iterator[bytes]:
+        """Stream a file of the working directory as tar archive."""
+        try:
+            chunks, stat = self._running_container().get_archive(
+                posixpath.join(WORKING_DIR, file_name), chunk_size=CHUNK_SIZE
+            )
+        except docker.errors.NotFound:
+            raise FileNotFoundError(file_name) from None
+        if stat["mode"] & _GO_MODE_DIR:
+            raise IsADirectoryError(file_name)
+        return chunks
 
     @property
     def ws_url(self) -> str:
@@ -0,0 +1,543 @@
+"""Base of the CodeBox'es running code in a jupyter kernel gateway.
+
+DockerBox and JupyterBox only differ in where the gateway runs, in a
+container or as a local process. Talking to the gateway and its kernel is
+the same for both and implemented here on top of the kernel clients of
+:mod:`openbox.box.kernel`.
+"""
+
+import asyncio
+import os
+import threading
+from typing import AsyncIterator, Iterator, List, Optional, Sequence, Union
+from uuid import UUID
+
+import aiohttp
+import requests  # type: ignore
+
+from openbox.box.base import BaseBox
+from openbox.box.kernel import (
+    RESET_CODE,
+    AsyncKernelClient,
+    KernelClient,
+    KernelUnresponsive,
+    Liveness,
+    aborted_output,
+    arefresh_liveness,
+    refresh_liveness,
+    run_timeout,
+)
+from openbox.config import settings
+from openbox.schema import CodeBoxOutput, CodeBoxStatus
+from openbox.websockets.client import WebSocketClientProtocol
+from openbox.websockets.client import connect as ws_connect
+from openbox.websockets.exceptions import ConnectionClosedError
+from openbox.websockets.sync.client import ClientConnection
+from openbox.websockets.sync.client import connect as ws_connect_sync
+
+
+class GatewayBox(BaseBox):
+    """A CodeBox running code in a kernel of a jupyter kernel gateway.
+
+    Subclasses start the gateway listening on ``port`` and connect to a
+    kernel with :meth:`_connect` or :meth:`_aconnect`. Sync calls use a
+    sync websocket and are serialized with ``_lock``, async calls share an
+    async websocket and run concurrently.
+    """
+
+    def __init__(self, session_id: Optional[UUID] = None) -> None:
+        super().__init__(session_id=session_id)
+        self.port: int = 8888
+        self.kernel_id: Optional[Union[str, UUID]] = None
+        self.ws: Union[WebSocketClientProtocol, ClientConnection, None] = None
+        self.kernel: Optional[AsyncKernelClient] = None
+        self._sync_kernel: Optional[KernelClient] = None
+        self.http_session = requests.Session()
+        self.aiohttp_session: Optional[aiohttp.ClientSession] = None
+        self.liveness = Liveness()
+        self.time_to_ready: Optional[float] = None
+        self._lock = threading.RLock()
+
+    def _connect(self) -> None:
+        """Create a kernel unless there is one and connect its websocket."""
+        if not self.kernel_id:
+            response = self.http_session.post(
+                f"{self.kernel_url}/kernels",
+                headers={"Content-Type": "application/json"},
+                timeout=270,
+            )
+            self.kernel_id = response.json()["id"]
+
+        if self.kernel_id is None:
+            raise Exception("Could not start kernel")
+
+        self.ws = ws_connect_sync(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels",
+            # outputs like large images exceed the default 1 MiB limit
+            max_size=None,
+        )
+
+        self.liveness.seen()
+
+    async def _aconnect(self) -> None:
+        if not self.kernel_id:
+            async with self._aiohttp().post(
+                f"{self.kernel_url}/kernels",
+                headers={"Content-Type": "application/json"},
+            ) as response:
+                self.kernel_id = (await response.json())["id"]
+        if self.kernel_id is None:
+            raise Exception("Could not start kernel")
+        self.ws = await ws_connect(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels",
+            max_size=None,
+        )
+        self.liveness.seen()
+
+    def _reconnect(self) -> None:
+        """Reconnect to the kernel after the websocket was closed.
+
+        The session is kept if its kernel is still there, otherwise it is
+        stopped and started anew, so it is never registered twice.
+        """
+        with self._lock:
+            if isinstance(self.ws, ClientConnection):
+                self.ws.close()
+            self.ws = None
+            try:
+                # fails fast, unlike a websocket handshake with a gone kernel
+                self.http_session.get(
+                    f"{self.kernel_url}/kernels/{self.kernel_id}", timeout=10
+                ).raise_for_status()
+                self._connect()
+            except Exception as e:
+                if settings.VERBOSE:
+                    print(f"Failed to reconnect, restarting the session: {e}")
+                self.stop()
+                self.start()
+
+    async def _areconnect(self) -> None:
+        """Async version of :meth:`_reconnect`."""
+        if self.kernel is not None:
+            await self.kernel.close()
+            self.kernel = None
+        elif isinstance(self.ws, WebSocketClientProtocol):
+            await self.ws.close()
+        self.ws = None
+        try:
+            async with self._aiohttp().get(
+                f"{self.kernel_url}/kernels/{self.kernel_id}"
+            ) as response:
+                response.raise_for_status()
+            await self._aconnect()
+        except Exception as e:
+            if settings.VERBOSE:
+                print(f"Failed to reconnect, restarting the session: {e}")
+            await self.astop()
+            await self.astart()
+
+    def status(self, refresh: bool = False) -> CodeBoxStatus:
+        """Return whether the kernel is running.
+
+        The status is answered from the liveness tracked through the kernel
+        messages. Once it is older than ``STATUS_MAX_AGE`` seconds, or with
+        ``refresh``, the websocket is pinged, falling back to the gateway's
+        REST API when there is no websocket or the ping is not answered.
+        """
+        if not self.kernel_id:
+            return CodeBoxStatus(status="stopped")
+        if refresh or not self.liveness.fresh():
+            refresh_liveness(
+                self.liveness,
+                self.ws,
+                self.http_session,
+                f"{self.kernel_url}/kernels/{self.kernel_id}",
+            )
+        return self.liveness.status
+
+    async def astatus(self, refresh: bool = False) -> CodeBoxStatus:
+        if not self.kernel_id:
+            return CodeBoxStatus(status="stopped")
+        if refresh or not self.liveness.fresh():
+            await arefresh_liveness(
+                self.liveness,
+                self.ws,
+                self._aiohttp(),
+                f"{self.kernel_url}/kernels/{self.kernel_id}",
+            )
+        return self.liveness.status
+
+    def run(
+        self,
+        code: Optional[str] = None,
+        file_path: Optional[os.PathLike] = None,
+        retry=3,
+        *,
+        timeout: Optional[float] = None,
+    ) -> CodeBoxOutput:
+        self._update()
+        if not code and not file_path:
+            raise ValueError("Code or file_path must be specified!")
+
+        if code and file_path:
+            raise ValueError("Can only specify code or the file to read_from!")
+
+        if file_path:
+            with open(file_path, "r", encoding="utf-8") as f:
+                code = f.read()
+
+        # run code in jupyter kernel
+        if retry <= 0:
+            raise RuntimeError("Could not connect to kernel")
+        if not self.ws:
+            self._connect()
+            if not self.ws:
+                raise RuntimeError(
+                    "Jupyter not running. Make sure to start it first."
+                )
+
+        with self._executing(), self._lock:
+            try:
+                output = self._kernel_client().execute(
+                    code, run_timeout(timeout), self._interrupt
+                )
+            except KernelUnresponsive as e:
+                # the kernel ignored the interrupt, restart it to free it
+                self.restart()
+                return e.output
+            except ConnectionClosedError:
+                self._reconnect()
+                return self.run(code, timeout=timeout, retry=retry - 1)
+        self._update()
+        output.events = self._output_events()
+        return output
+
+    async def arun(
+        self,
+        code: str,
+        file_path: Optional[os.PathLike] = None,
+        retry=3,
+        *,
+        timeout: Optional[float] = None,
+    ) -> CodeBoxOutput:
+        self._update()
+        if file_path:
+            raise NotImplementedError(
+                "Reading from file is not supported in async mode"
+            )
+
+        # run code in jupyter kernel
+        if retry <= 0:
+            raise RuntimeError("Could not connect to kernel")
+        if not self.ws:
+            await self._aconnect()
+            if not self.ws:
+                raise RuntimeError(
+                    "Jupyter not running. Make sure to start it first."
+                )
+
+        if settings.VERBOSE:
+            print("Running code:\n", code)
+
+        try:
+            with self._executing():
+                output = await self._async_kernel_client().execute(
+                    code, run_timeout(timeout), self._ainterrupt
+                )
+        except KernelUnresponsive as e:
+            await self.arestart()
+            return e.output
+        except ConnectionClosedError:
+            await self._areconnect()
+            return await self.arun(code, file_path, retry - 1, timeout=timeout)
+        self._update()
+        output.events = self._output_events()
+        return output
+
+    def run_many(
+        self,
+        codes: Sequence[str],
+        stop_on_error: bool = True,
+        timeout: Optional[float] = None,
+    ) -> List[CodeBoxOutput]:
+        """Execute many pieces of python code in order.
+
+        Without ``stop_on_error`` all code is sent to the kernel back to
+        back, saving a round trip per code compared to calling :meth:`run`
+        for each. With it the next code is only sent once the previous one
+        succeeded. Code which didn't run because of a failure, or because
+        the kernel died or was restarted, gets an output of type
+        ``aborted``. Events like resource limits hit are reported
+        in the ``events`` of the last output.
+        """
+        self._update()
+        if not self.ws:
+            self._connect()
+
+        outputs: List[CodeBoxOutput] = []
+        with self._executing(), self._lock:
+            try:
+                for output in self._kernel_client().execute_many(
+                    codes, run_timeout(timeout), self._interrupt, stop_on_error
+                ):
+                    outputs.append(output)
+            except KernelUnresponsive as e:
+                # the kernel ignored the interrupt, restart it to free it
+                outputs.append(e.output)
+                self.restart()
+        while len(outputs) < len(codes):
+            outputs.append(aborted_output())
+        self._update()
+        if outputs:
+            outputs[-1].events = self._output_events()
+        return outputs
+
+    async def arun_many(
+        self,
+        codes: Sequence[str],
+        stop_on_error: bool = True,
+        timeout: Optional[float] = None,
+    ) -> List[CodeBoxOutput]:
+        """Async version of :meth:`run_many`."""
+        self._update()
+        if not self.ws:
+            await self._aconnect()
+
+        outputs: List[CodeBoxOutput] = []
+        try:
+            with self._executing():
+                async for output in self._async_kernel_client().execute_many(
+                    codes,
+                    run_timeout(timeout),
+                    self._ainterrupt,
+                    stop_on_error,
+                ):
+                    outputs.append(output)
+        except KernelUnresponsive as e:
+            outputs.append(e.output)
+            await self.arestart()
+        while len(outputs) < len(codes):
+            outputs.append(aborted_output())
+        self._update()
+        if outputs:
+            outputs[-1].events = self._output_events()
+        return outputs
+
+    def run_stream(
+        self, code: str, *, timeout: Optional[float] = None
+    ) -> Iterator[CodeBoxOutput]:
+        """Execute python code and yield its outputs as they arrive.
+
+        Yields ``stdout``, ``stderr``, ``execute_result``, ``display_data``
+        and ``error`` events until the kernel finished the execution. After
+        the timeout the kernel is interrupted and a ``timeout`` event is
+        yielded. The lock is only held while waiting for the next event, so
+        the box can be used while iterating.
+        """
+        self._update()
+        if not self.ws:
+            self._connect()
+
+        with self._lock:
+            events = self._kernel_client().stream(
+                code, run_timeout(timeout), self._interrupt
+            )
+        try:
+            with self._executing():
+                while True:
+                    with self._lock:
+                        event = next(events, None)
+                    if event is None:
+                        return
+                    self._update()
+                    yield event
+        except KernelUnresponsive:
+            # the kernel ignored the interrupt, restart it to free it
+            self.restart()
+        finally:
+            events.close()
+
+    async def arun_stream(
+        self, code: str, *, timeout: Optional[float] = None
+    ) -> AsyncIterator[CodeBoxOutput]:
+        """Async version of :meth:`run_stream`."""
+        self._update()
+        if not self.ws:
+            await self._aconnect()
+
+        events = self._async_kernel_client().stream(
+            code, run_timeout(timeout), self._ainterrupt
+        )
+        try:
+            with self._executing():
+                async for event in events:
+                    self._update()
+                    yield event
+        except KernelUnresponsive:
+            await self.arestart()
+        finally:
+            await events.aclose()
+
+    def _output_events(self) -> List[str]:
+        """Return the events to report with the output of an execution."""
+        return []
+
+    def _kernel_client(self) -> KernelClient:
+        if not isinstance(self.ws, ClientConnection):
+            raise RuntimeError("Mixing asyncio and sync code is not supported")
+        # shared, so messages of a stream read by a run are kept for it
+        if self._sync_kernel is None or self._sync_kernel.ws is not self.ws:
+            self._sync_kernel = KernelClient(self.ws, self.liveness)
+        return self._sync_kernel
+
+    def _async_kernel_client(self) -> AsyncKernelClient:
+        if not isinstance(self.ws, WebSocketClientProtocol):
+            raise RuntimeError("Mixing asyncio and sync code is not supported")
+        if self.kernel is None or self.kernel.ws is not self.ws:
+            self.kernel = AsyncKernelClient(self.ws, self.liveness)
+        return self.kernel
+
+    def restart(self, soft: bool = False) -> CodeBoxStatus:
+        """Restart the kernel or with ``soft`` only clear its namespace.
+
+        A restart respawns the kernel process through the gateway and
+        reconnects the websocket, it waits for running executions to finish.
+        A soft restart falls back to a full one if clearing the namespace
+        failed. Files are kept in both cases.
+        """
+        self._update()
+        if soft:
+            output = self.run(RESET_CODE)
+            if output.type == "text":
+                return CodeBoxStatus(status="restarted")
+            if settings.VERBOSE:
+                print(f"Soft restart failed, restarting the kernel: {output}")
+
+        with self._lock:
+            self.http_session.post(
+                f"{self.kernel_url}/kernels/{self.kernel_id}/restart",
+                timeout=270,
+            ).raise_for_status()
+            if isinstance(self.ws, ClientConnection):
+                self.ws.close()
+            self.ws = ws_connect_sync(
+                f"{self.ws_url}/kernels/{self.kernel_id}/channels",
+                max_size=None,
+            )
+            self.liveness.seen()
+        return CodeBoxStatus(status="restarted")
+
+    async def arestart(self, soft: bool = False) -> CodeBoxStatus:
+        """Async version of :meth:`restart`.
+
+        Executions still pending on the kernel don't run, their output is of
+        type ``aborted``.
+        """
+        self._update()
+        if soft:
+            output = await self.arun(RESET_CODE)
+            if output.type == "text":
+                return CodeBoxStatus(status="restarted")
+            if settings.VERBOSE:
+                print(f"Soft restart failed, restarting the kernel: {output}")
+
+        async with self._aiohttp().post(
+            f"{self.kernel_url}/kernels/{self.kernel_id}/restart"
+        ) as response:
+            response.raise_for_status()
+        if self.kernel is not None:
+            await self.kernel.close()
+            self.kernel = None
+        elif isinstance(self.ws, WebSocketClientProtocol):
+            await self.ws.close()
+        self.ws = await ws_connect(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels",
+            max_size=None,
+        )
+        self.liveness.seen()
+        return CodeBoxStatus(status="restarted")
+
+    def _disconnect(self) -> None:
+        """Close the connections to the kernel from any thread.
+
+        An async websocket is closed on the event loop it belongs to, the
+        sync websocket and the HTTP session are closed right away.
+        """
+        if self.ws is not None:
+            try:
+                if isinstance(self.ws, ClientConnection):
+                    self.ws.close()
+                elif self.ws.loop.is_running():
+                    asyncio.run_coroutine_threadsafe(
+                        self.ws.close(), self.ws.loop
+                    )
+            except ConnectionClosedError:
+                pass
+            self.ws = None
+        self.kernel = None
+        self.liveness.lost()
+        self.http_session.close()
+
+    async def _adisconnect(self) -> None:
+        """Async version of :meth:`_disconnect`, also closes aiohttp."""
+        if self.kernel is not None:
+            await self.kernel.close()
+            self.kernel = None
+
+        if self.ws is not None:
+            try:
+                if isinstance(self.ws, WebSocketClientProtocol):
+                    await self.ws.close()
+                else:
+                    self.ws.close()
+            except ConnectionClosedError:
+                pass
+            self.ws = None
+
+        if self.aiohttp_session is not None:
+            await self.aiohttp_session.close()
+            self.aiohttp_session = None
+        self.liveness.lost()
+        self.http_session.close()
+
+    def _aiohttp(self) -> aiohttp.ClientSession:
+        """Return the aiohttp session of the box, created on first use.
+
+        The session keeps the connections to the gateway alive and is closed
+        by astop.
+        """
+        if self.aiohttp_session is None or self.aiohttp_session.closed:
+            self.aiohttp_session = aiohttp.ClientSession()
+        return self.aiohttp_session
+
+    def _interrupt(self) -> None:
+        """Interrupt the code the kernel is running, like Ctrl+C."""
+        try:
+            self.http_session.post(
+                f"{self.kernel_url}/kernels/{self.kernel_id}/interrupt",
+                timeout=settings.INTERRUPT_TIMEOUT,
+            )
+        except requests.exceptions.RequestException:
+            pass
+
+    async def _ainterrupt(self) -> None:
+        try:
+            async with self._aiohttp().post(
+                f"{self.kernel_url}/kernels/{self.kernel_id}/interrupt",
+                timeout=aiohttp.ClientTimeout(
+                    total=settings.INTERRUPT_TIMEOUT
+                ),
+            ):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    @property
+    def kernel_url(self) -> str:
+        """Return the url of the kernel."""
+        return f"http://localhost:{self.port}/api"
+
+    @property
+    def ws_url(self) -> str:
+        """Return the url of the websocket."""
+        return f"ws://localhost:{self.port}/api"
@@ -0,0 +1,1019 @@
+"""Jupyter kernel messaging shared by the kernel gateway CodeBox'es.
+
+The kernel gateway exposes all channels of a kernel (shell, iopub, ...)
+over one websocket. Every message replying to an execute_request carries
+the msg_id of that request in its parent_header, which is used here to
+route the messages to the execution they belong to. The sync and async
+clients only differ in the transport, both hand the messages of an
+execution to :class:`Execution`, which dispatches them by msg_type.
+"""
+
+import asyncio
+import json
+import re
+import struct
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from uuid import uuid4
+
+import aiohttp
+import requests  # type: ignore
+
+from openbox.box.capture import OutputCapture
+from openbox.box.serializer import serializer
+from openbox.config import settings
+from openbox.schema import CodeBoxOutput, CodeBoxStatus
+from openbox.websockets.client import WebSocketClientProtocol
+from openbox.websockets.exceptions import ConnectionClosed
+from openbox.websockets.sync.client import ClientConnection
+
+
+# clears the user namespace without restarting the interpreter
+RESET_CODE = "%reset -f"
+
+# execution states reported by the gateway when the kernel process died
+DIED_STATES = ("restarting", "dead")
+KERNEL_DIED = "KernelDied: The kernel died while executing the code"
+# content of outputs of queued code the kernel dropped without running it
+ABORTED = "Aborted: The kernel did not run the code"
+
+# frames of this size or larger are decoded lazily, see LazyMessage
+LAZY_CONTENT_SIZE = 64 * 1024
+
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_SCALAR = re.compile(r"[^,}\]\s]*")
+
+
+def _execute_request_template(stop_on_error: bool) -> Tuple[str, str, str]:
+    """Serialize an execute_request with placeholders for msg_id and code.
+
+    Returns the JSON before the msg_id, between msg_id and code and after
+    the code, so a request can be built by concatenating the parts.
+    """
+    template = json.dumps(
+        {
+            "header": {
+                "msg_id": "{msg_id}",
+                "msg_type": "execute_request",
+            },
+            "parent_header": {},
+            "metadata": {},
+            "content": {
+                "code": "{code}",
+                "silent": False,
+                "store_history": True,
+                "user_expressions": {},
+                "allow_stdin": False,
+                "stop_on_error": stop_on_error,
+            },
+            "channel": "shell",
+            "buffers": [],
+        }
+    )
+    head, rest = template.split("{msg_id}")
+    middle, tail = rest.split('"{code}"')
+    return head, middle, tail
+
+
+_EXECUTE_REQUESTS = {
+    stop_on_error: _execute_request_template(stop_on_error)
+    for stop_on_error in (True, False)
+}
+
+
+def execute_request(code: str, msg_id: str, stop_on_error: bool = True) -> str:
+    """Serialize an execute_request message for the kernel.
+
+    Only the code is encoded, the rest of the message is serialized once.
+    With ``stop_on_error`` the kernel skips the requests queued after this
+    one if it fails. The msg_id must not contain characters which need
+    escaping in JSON, like the hex of an uuid.
+    """
+    head, middle, tail = _EXECUTE_REQUESTS[stop_on_error]
+    return head + msg_id + middle + serializer().dumps(code) + tail
+
+
+class LazyMessage(dict):
+    """A kernel message whose content is decoded on first access.
+
+    Only the envelope with the header and parent_header is decoded right
+    away, so skipping a message or checking its type doesn't pay for
+    decoding large content like base64 encoded images. The content is
+    decoded by ``message["content"]`` and ``message.get("content")``.
+    """
+
+    def __init__(self, frame: str, start: int, end: int) -> None:
+        super().__init__(
+            serializer().loads(frame[:start] + "null" + frame[end:])
+        )
+        del self["content"]
+        self._frame: Optional[str] = frame
+        self._span = (start, end)
+
+    def __missing__(self, key: str) -> Any:
+        if key != "content" or self._frame is None:
+            raise KeyError(key)
+        start, end = self._span
+        content = self["content"] = serializer().loads(self._frame[start:end])
+        self._frame = None
+        return content
+
+    def __contains__(self, key: object) -> bool:
+        return super().__contains__(key) or (
+            key == "content" and self._frame is not None
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def deserialize(frame: Union[str, bytes]) -> dict:
+    """Parse a kernel message received over the websocket.
+
+    Large text frames become a :class:`LazyMessage`. Messages with binary
+    buffers arrive as binary frames: a count, a table of offsets, the JSON
+    message and then the buffers. The buffers are put into the message as
+    memoryviews into the frame instead of copies.
+    """
+    if isinstance(frame, str):
+        if len(frame) >= LAZY_CONTENT_SIZE:
+            if (span := _content_span(frame)) is not None:
+                return LazyMessage(frame, *span)
+        return serializer().loads(frame)
+    view = memoryview(frame)
+    (count,) = struct.unpack_from("!I", view)
+    offsets = struct.unpack_from(f"!{count}I", view, 4)
+    ends = offsets[1:] + (len(view),)
+    received_msg = serializer().loads(bytes(view[offsets[0] : ends[0]]))
+    received_msg["buffers"] = [
+        view[start:end] for start, end in zip(offsets[1:], ends[1:])
+    ]
+    return received_msg
+
+
+def _content_span(frame: str) -> Optional[Tuple[int, int]]:
+    """Return where the content of a JSON encoded message starts and ends.
+
+    Only scans for the structure of the JSON, strings like base64 encoded
+    images are skipped with a search for their closing quote.
+    """
+    try:
+        i = _skip_whitespace(frame, 0)
+        if frame[i] != "{":
+            return None
+        i += 1
+        while True:
+            key_start = _skip_whitespace(frame, i)
+            key_end = _string_end(frame, key_start)
+            i = _skip_whitespace(frame, key_end)
+            if frame[i] != ":":
+                return None
+            start = _skip_whitespace(frame, i + 1)
+            end = _value_end(frame, start)
+            if frame[key_start:key_end] == '"content"':
+                return start, end
+            i = _skip_whitespace(frame, end)
+            if frame[i] != ",":
+                return None
+            i += 1
+    except (IndexError, ValueError):
+        return None
+
+
+def _skip_whitespace(frame: str, i: int) -> int:
+    while frame[i] in " \t\n\r":
+        i += 1
+    return i
+
+
+def _string_end(frame: str, start: int) -> int:
+    """Return the index after the JSON string starting at start."""
+    if frame[start] != '"':
+        raise ValueError("Expected a string")
+    end = start
+    while True:
+        end = frame.index('"', end + 1)
+        escapes = 0
+        while frame[end - 1 - escapes] == "\\":
+            escapes += 1
+        if escapes % 2 == 0:
+            return end + 1
+
+
+def _value_end(frame: str, start: int) -> int:
+    """Return the index after the JSON value starting at start."""
+    if frame[start] == '"':
+        return _string_end(frame, start)
+    if frame[start] not in "{[":
+        return _SCALAR.match(frame, start).end()  # type: ignore
+    depth = 0
+    i = start
+    while True:
+        match = _STRUCTURE.search(frame, i)
+        if match is None:
+            raise ValueError("Unterminated JSON value")
+        char = match.group()
+        if char == '"':
+            i = _string_end(frame, match.start())
+            continue
+        i = match.end()
+        depth += 1 if char in "{[" else -1
+        if depth == 0:
+            return i
+
+
+def is_idle(received_msg: dict) -> bool:
+    """Check if the message reports the kernel went idle."""
+    return (
+        received_msg["header"]["msg_type"] == "status"
+        and received_msg["content"]["execution_state"] == "idle"
+    )
+
+
+def timeout_message(msg_id: str, timeout: float) -> dict:
+    """Create the message marking that an execution ran into its timeout.
+
+    It is put between the messages of the execution when the kernel gets
+    interrupted, so the outputs up to the interrupt are kept.
+    """
+    return {
+        "header": {"msg_type": "timeout"},
+        "parent_header": {"msg_id": msg_id},
+        "content": {"timeout": timeout},
+    }
+
+
+def run_timeout(timeout: Optional[float]) -> Optional[float]:
+    """Return the timeout of an execution, by default the configured one."""
+    return settings.RUN_TIMEOUT if timeout is None else timeout
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Return the seconds left until the monotonic deadline, if any."""
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+def kernel_died(received_msg: dict) -> bool:
+    """Check if the message reports the kernel process died.
+
+    The gateway sends these without a parent_header when the kernel exited,
+    e.g. after it was killed for exceeding the memory limit, and restarts
+    it automatically if possible. All pending executions are lost then.
+    """
+    return (
+        received_msg["header"]["msg_type"] == "status"
+        and received_msg["content"]["execution_state"] in DIED_STATES
+    )
+
+
+def _stream_event(received_msg: dict) -> CodeBoxOutput:
+    content = received_msg["content"]
+    return CodeBoxOutput.model_construct(
+        type=content["name"], content=content["text"]
+    )
+
+
+def _data_event(received_msg: dict) -> CodeBoxOutput:
+    data = received_msg["content"]["data"]
+    output = CodeBoxOutput.model_construct(
+        type=received_msg["header"]["msg_type"],
+        content=data.get("text/plain", ""),
+        data=data,
+    )
+    if buffers := received_msg.get("buffers"):
+        output._buffers = list(buffers)
+    return output
+
+
+def _error_event(received_msg: dict) -> CodeBoxOutput:
+    content = received_msg["content"]
+    return CodeBoxOutput.model_construct(
+        type="error", content=f"{content['ename']}: {content['evalue']}"
+    )
+
+
+def _status_event(received_msg: dict) -> Optional[CodeBoxOutput]:
+    if received_msg["content"]["execution_state"] in DIED_STATES:
+        return CodeBoxOutput.model_construct(type="error", content=KERNEL_DIED)
+    return None
+
+
+def _timeout_event(received_msg: dict) -> CodeBoxOutput:
+    return CodeBoxOutput.model_construct(
+        type="timeout", content=_timed_out(received_msg["content"]["timeout"])
+    )
+
+
+_OUTPUT_EVENTS: Dict[str, Callable[[dict], Optional[CodeBoxOutput]]] = {
+    "stream": _stream_event,
+    "execute_result": _data_event,
+    "display_data": _data_event,
+    "error": _error_event,
+    "status": _status_event,
+    "timeout": _timeout_event,
+}
+
+
+def output_event(received_msg: dict) -> Optional[CodeBoxOutput]:
+    """Convert an iopub message into a typed output event.
+
+    Stream messages become ``stdout``/``stderr`` events with the raw text,
+    ``execute_result`` and ``display_data`` events carry their MIME bundle
+    in ``data``. Messages which are not outputs return None.
+
+    The kernel messages are trusted, so the outputs are constructed without
+    validating their (possibly multi-MB) content again.
+    """
+    event = _OUTPUT_EVENTS.get(received_msg["header"]["msg_type"])
+    return None if event is None else event(received_msg)
+
+
+def aborted_output() -> CodeBoxOutput:
+    """Create the output of code which was queued but never ran."""
+    return CodeBoxOutput.model_construct(type="aborted", content=ABORTED)
+
+
+class Liveness:
+    """Tracks when a kernel was last seen alive.
+
+    Every message of the kernel, answered ping and successful status request
+    is a sign of life. Status messages also carry the execution_state of the
+    kernel, which reports ``dead`` when the kernel died.
+    """
+
+    def __init__(self) -> None:
+        self.alive = False
+        self.execution_state: Optional[str] = None
+        self.last_seen: Optional[float] = None
+
+    def seen(self, execution_state: Optional[str] = None) -> None:
+        """Record a sign of life and optionally the new execution_state."""
+        if execution_state is not None:
+            self.execution_state = execution_state
+        self.alive = self.execution_state != "dead"
+        self.last_seen = time.monotonic()
+
+    def observe(self, received_msg: dict) -> None:
+        """Record a message received from the kernel."""
+        if received_msg["header"]["msg_type"] == "status":
+            self.seen(received_msg["content"]["execution_state"])
+        else:
+            self.seen()
+
+    def lost(self) -> None:
+        """Record that the kernel could not be reached."""
+        self.alive = False
+        self.last_seen = time.monotonic()
+
+    def fresh(self, max_age: Optional[float] = None) -> bool:
+        """Check if the tracked state is younger than max_age seconds."""
+        if max_age is None:
+            max_age = settings.STATUS_MAX_AGE
+        return (
+            self.last_seen is not None
+            and time.monotonic() - self.last_seen <= max_age
+        )
+
+    @property
+    def status(self) -> CodeBoxStatus:
+        return CodeBoxStatus(status="running" if self.alive else "stopped")
+
+
+def refresh_liveness(
+    liveness: Liveness,
+    ws: Union[WebSocketClientProtocol, ClientConnection, None],
+    http_session: requests.Session,
+    kernel_model_url: str,
+) -> None:
+    """Check if the kernel is alive and record the result in liveness.
+
+    Pings the websocket, which the gateway answers even while the kernel is
+    busy. Without a websocket or when the ping is not answered the kernel
+    model is requested from the gateway's REST API instead.
+    """
+    if isinstance(ws, ClientConnection):
+        try:
+            if ws.ping().wait(settings.STATUS_TIMEOUT):
+                liveness.seen()
+                return
+        except (ConnectionClosed, RuntimeError):
+            pass
+    try:
+        response = http_session.get(
+            kernel_model_url, timeout=settings.STATUS_TIMEOUT
+        )
+    except requests.exceptions.RequestException:
+        liveness.lost()
+        return
+    if response.status_code == 200:
+        liveness.seen(response.json().get("execution_state"))
+    else:
+        liveness.lost()
+
+
+async def arefresh_liveness(
+    liveness: Liveness,
+    ws: Union[WebSocketClientProtocol, ClientConnection, None],
+    session: aiohttp.ClientSession,
+    kernel_model_url: str,
+) -> None:
+    """Async version of :func:`refresh_liveness`."""
+    if isinstance(ws, WebSocketClientProtocol):
+        try:
+            await asyncio.wait_for(await ws.ping(), settings.STATUS_TIMEOUT)
+            liveness.seen()
+            return
+        except (ConnectionClosed, RuntimeError, asyncio.TimeoutError):
+            pass
+    try:
+        async with session.get(
+            kernel_model_url,
+            timeout=aiohttp.ClientTimeout(total=settings.STATUS_TIMEOUT),
+        ) as response:
+            if response.status == 200:
+                model = await response.json()
+                liveness.seen(model.get("execution_state"))
+            else:
+                liveness.lost()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        liveness.lost()
+
+
+class KernelUnresponsive(TimeoutError):
+    """The kernel kept running an execution after it was interrupted.
+
+    Carries the ``timeout`` output of the execution, the kernel has to be
+    restarted before it can be used again.
+    """
+
+    def __init__(self, output: CodeBoxOutput) -> None:
+        super().__init__("The kernel did not stop after an interrupt")
+        self.output = output
+
+
+class KernelClosed(RuntimeError):
+    """The kernel connection was closed while the execution was pending.
+
+    Happens when the kernel is restarted, the execution is reported as
+    ``aborted`` then.
+    """
+
+
+class Execution:
+    """Collects all outputs of one execute_request until it is finished.
+
+    The execution is finished once the kernel is idle again and sent the
+    execute_reply. Both are needed because the reply arrives on the shell
+    channel, which is not ordered with the iopub channel of the status.
+    Consecutive chunks of the same stream are merged into one output, the
+    other outputs are kept in the order the kernel sent them. The printed
+    text is captured by ``capture``, stream chunks beyond ``max_size``
+    characters are dropped from the outputs.
+    """
+
+    def __init__(
+        self,
+        capture: Optional[OutputCapture] = None,
+        max_size: Optional[int] = None,
+    ) -> None:
+        self.outputs: List[CodeBoxOutput] = []
+        self.capture = capture or OutputCapture()
+        self.max_size = (
+            settings.OUTPUT_MAX_SIZE if max_size is None else max_size
+        )
+        self.truncated = False
+        self.image: Optional[str] = None
+        self.error: Optional[str] = None
+        self.timeout: Optional[float] = None
+        self.died = False
+        self.aborted = False
+        self.idle = False
+        self.replied = False
+        self._stream: Optional[str] = None
+        self._stream_text: List[str] = []
+        self._stream_size = 0
+
+    def handle(self, received_msg: dict) -> Optional[CodeBoxOutput]:
+        """Process a message sent in reply to this execution.
+
+        Returns the output once the execution is finished.
+        """
+        handler = self._handlers.get(received_msg["header"]["msg_type"])
+        return None if handler is None else handler(self, received_msg)
+
+    def _on_stream(self, received_msg: dict) -> None:
+        content = received_msg["content"]
+        if content["name"] != self._stream:
+            self._flush_stream()
+            self._stream = content["name"]
+        text = content["text"]
+        kept = text
+        if self.max_size is not None:
+            kept = text[: max(self.max_size - self._stream_size, 0)]
+            self.truncated = self.truncated or len(kept) < len(text)
+        if kept:
+            self._stream_text.append(kept)
+            self._stream_size += len(kept)
+        msg = text.strip()
+        if "Requirement already satisfied:" in msg:
+            return
+        self.capture.write(msg + "\n")
+        if settings.VERBOSE:
+            print("Output:\n", msg)
+
+    def _on_data(self, received_msg: dict) -> None:
+        self._flush_stream()
+        event = _data_event(received_msg)
+        self.outputs.append(event)
+        data = received_msg["content"]["data"]
+        if "image/png" in data:
+            if self.image is None:
+                self.image = data["image/png"]
+        elif "text/plain" in data:
+            self.capture.write(data["text/plain"].strip() + "\n")
+            if settings.VERBOSE:
+                print("Output:\n", event.content)
+
+    def _on_error(self, received_msg: dict) -> None:
+        self._flush_stream()
+        event = _error_event(received_msg)
+        self.outputs.append(event)
+        self.error = event.content
+        if settings.VERBOSE:
+            print("Error:\n", self.error)
+
+    def _on_status(self, received_msg: dict) -> Optional[CodeBoxOutput]:
+        execution_state = received_msg["content"]["execution_state"]
+        if execution_state == "idle":
+            self._flush_stream()
+            self.idle = True
+            return self.result() if self.replied else None
+        if execution_state in DIED_STATES:
+            self._flush_stream()
+            self.outputs.append(
+                CodeBoxOutput.model_construct(
+                    type="error", content=KERNEL_DIED
+                )
+            )
+            self.error = KERNEL_DIED
+            self.died = True
+            return self.result()
+        return None
+
+    def _on_reply(self, received_msg: dict) -> Optional[CodeBoxOutput]:
+        self.replied = True
+        # the kernel skipped the code after an earlier execution failed
+        if received_msg["content"]["status"] == "aborted":
+            self.aborted = True
+        return self.result() if self.idle else None
+
+    def _on_timeout(self, received_msg: dict) -> None:
+        self._flush_stream()
+        self.timeout = received_msg["content"]["timeout"]
+
+    # msg_type -> handler, messages of other types are ignored
+    _handlers: Dict[
+        str, Callable[["Execution", dict], Optional[CodeBoxOutput]]
+    ] = {
+        "stream": _on_stream,
+        "execute_result": _on_data,
+        "display_data": _on_data,
+        "error": _on_error,
+        "status": _on_status,
+        "execute_reply": _on_reply,
+        "timeout": _on_timeout,
+    }
+
+    @property
+    def failed(self) -> bool:
+        """Whether the code failed, timed out or didn't run at all."""
+        return (
+            self.aborted
+            or self.died
+            or self.timeout is not None
+            or self.error is not None
+        )
+
+    def result(self) -> CodeBoxOutput:
+        """Summarize the outputs collected so far.
+
+        The output is of type ``aborted`` if the kernel didn't run the code,
+        ``timeout`` if the execution was interrupted after its timeout,
+        ``error`` if it failed, otherwise ``image/png`` with the first image
+        if one was displayed or ``text`` with the printed text. All outputs
+        are available in ``outputs``.
+        """
+        if self.aborted:
+            output_type, content = "aborted", ABORTED
+        elif self.timeout is not None:
+            output_type, content = "timeout", _timed_out(self.timeout)
+        elif self.error is not None:
+            output_type, content = "error", self.error
+        elif self.image is not None:
+            output_type, content = "image/png", self.image
+        else:
+            output_type, content = "text", self.capture.summary()
+            content = content or "code run successfully (no output)"
+        self.capture.close()
+        return CodeBoxOutput.model_construct(
+            type=output_type,
+            content=content,
+            outputs=self.outputs,
+            truncated=self.truncated or self.capture.truncated,
+            log_file=self.capture.log_file,
+        )
+
+    def _flush_stream(self) -> None:
+        if self._stream is not None:
+            self.outputs.append(
+                CodeBoxOutput.model_construct(
+                    type=self._stream, content="".join(self._stream_text)
+                )
+            )
+            self._stream = None
+            self._stream_text = []
+
+
+def _timed_out(timeout: float) -> str:
+    return f"TimeoutError: Execution exceeded the timeout of {timeout}s"
+
+
+def _timeout_output(timeout: Optional[float]) -> CodeBoxOutput:
+    assert timeout is not None
+    return CodeBoxOutput.model_construct(
+        type="timeout", content=_timed_out(timeout)
+    )
+
+
+class KernelClient:
+    """Runs executions over one sync kernel websocket.
+
+    The counterpart of :class:`AsyncKernelClient` for the sync transport,
+    both feed the messages of an execution into :class:`Execution`. Only
+    one thread may use the client at a time, the caller has to serialize
+    the calls. Messages of other executions sent by this client which
+    arrive while waiting for one execution are kept for them.
+    """
+
+    def __init__(
+        self, ws: ClientConnection, liveness: Optional[Liveness] = None
+    ) -> None:
+        self.ws = ws
+        self.liveness = liveness or Liveness()
+        self._pending: Dict[str, Deque[dict]] = {}
+
+    def execute(
+        self,
+        code: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+    ) -> CodeBoxOutput:
+        """Send an execute_request and wait for its output.
+
+        See :meth:`AsyncKernelClient.execute` for the timeout handling.
+        """
+        msg_id = self._send(code)
+        try:
+            output, _ = self._collect(msg_id, timeout, interrupt)
+            return output
+        finally:
+            self._pending.pop(msg_id, None)
+
+    def execute_many(
+        self,
+        codes: Iterable[str],
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+        stop_on_error: bool = True,
+    ) -> Iterator[CodeBoxOutput]:
+        """Execute the codes in order and yield their outputs.
+
+        Without ``stop_on_error`` all execute_requests are sent back to back,
+        so the kernel runs the code without waiting for a round trip in
+        between. With ``stop_on_error`` the next code is only sent once the
+        previous one succeeded, the kernel would still run code it received
+        after a failure. Stops early after a failure or if the kernel died,
+        the caller accounts for the code which didn't run. The timeout
+        applies to each code on its own.
+        """
+        codes = list(codes)
+        sent: List[str] = []
+        if not stop_on_error:
+            sent = [self._send(code, stop_on_error) for code in codes]
+        try:
+            for i, code in enumerate(codes):
+                if stop_on_error:
+                    sent.append(self._send(code))
+                output, execution = self._collect(sent[i], timeout, interrupt)
+                yield output
+                if execution.died or (stop_on_error and execution.failed):
+                    return
+        finally:
+            for msg_id in sent:
+                self._pending.pop(msg_id, None)
+
+    def stream(
+        self,
+        code: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+    ) -> Iterator[CodeBoxOutput]:
+        """Send an execute_request and yield its outputs as they arrive.
+
+        After the timeout the kernel is interrupted and a ``timeout`` event
+        yielded, see :meth:`AsyncKernelClient.execute`. The client may be
+        used for other executions between the events.
+        """
+        msg_id = self._send(code)
+        try:
+            for received_msg in self._replies(msg_id, timeout, interrupt):
+                if (event := output_event(received_msg)) is not None:
+                    yield event
+                if is_idle(received_msg) or kernel_died(received_msg):
+                    return
+        except TimeoutError:
+            raise KernelUnresponsive(_timeout_output(timeout)) from None
+        finally:
+            self._pending.pop(msg_id, None)
+
+    def _send(self, code: str, stop_on_error: bool = True) -> str:
+        if settings.VERBOSE:
+            print("Running code:\n", code)
+        msg_id = uuid4().hex
+        self._pending[msg_id] = deque()
+        self.ws.send(execute_request(code, msg_id, stop_on_error))
+        return msg_id
+
+    def _collect(
+        self,
+        msg_id: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+    ) -> Tuple[CodeBoxOutput, "Execution"]:
+        execution = Execution()
+        try:
+            for received_msg in self._replies(msg_id, timeout, interrupt):
+                if (output := execution.handle(received_msg)) is not None:
+                    return output, execution
+        except TimeoutError:
+            raise KernelUnresponsive(execution.result()) from None
+        raise AssertionError("unreachable")
+
+    def _replies(
+        self,
+        msg_id: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+    ) -> Iterator[dict]:
+        """Yield the messages replying to the execute_request msg_id.
+
+        When the execution takes longer than timeout seconds ``interrupt``
+        is called and a timeout message is yielded. Raises TimeoutError if
+        the kernel is not idle again within the INTERRUPT_TIMEOUT.
+        """
+        pending = self._pending[msg_id]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interrupted = False
+        while True:
+            if pending:
+                yield pending.popleft()
+                continue
+            try:
+                frame = self.ws.recv(remaining(deadline))
+            except TimeoutError:
+                if interrupted:
+                    raise
+                assert timeout is not None
+                yield timeout_message(msg_id, timeout)
+                if interrupt is not None:
+                    interrupt()
+                interrupted = True
+                deadline = time.monotonic() + settings.INTERRUPT_TIMEOUT
+                continue
+            received_msg = deserialize(frame)
+            self.liveness.observe(received_msg)
+            if kernel_died(received_msg):
+                for queue in self._pending.values():
+                    queue.append(received_msg)
+                continue
+            parent_id = received_msg["parent_header"].get("msg_id")
+            if parent_id == msg_id:
+                yield received_msg
+            elif (queue := self._pending.get(parent_id)) is not None:
+                queue.append(received_msg)
+
+
+class AsyncKernelClient:
+    """Runs concurrent executions over one async kernel websocket.
+
+    A background task reads every message from the websocket and puts it
+    into the queue of the execution it belongs to, so many coroutines can
+    send their execute_requests at the same time without stealing each
+    other's messages. The kernel queues the requests and runs them in order.
+    """
+
+    def __init__(
+        self,
+        ws: WebSocketClientProtocol,
+        liveness: Optional[Liveness] = None,
+    ) -> None:
+        self.ws = ws
+        self.liveness = liveness or Liveness()
+        self._queues: Dict[str, "asyncio.Queue[Any]"] = {}
+        self._reader: Optional["asyncio.Task[None]"] = None
+
+    async def execute(
+        self,
+        code: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> CodeBoxOutput:
+        """Send an execute_request and wait for its output.
+
+        The ``timeout`` starts once the kernel started the execution, not
+        while it is still queued behind others. When it expires
+        ``interrupt`` is called to stop the kernel and the output is of type
+        ``timeout`` once the kernel is idle again. Raises
+        :class:`KernelUnresponsive` if it doesn't stop within the
+        INTERRUPT_TIMEOUT.
+        """
+        msg_id, queue = await self._send(code)
+        try:
+            output, _ = await self._collect(msg_id, queue, timeout, interrupt)
+            return output
+        finally:
+            self._queues.pop(msg_id, None)
+
+    async def execute_many(
+        self,
+        codes: Iterable[str],
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], Awaitable[None]]] = None,
+        stop_on_error: bool = True,
+    ) -> AsyncIterator[CodeBoxOutput]:
+        """Async version of :meth:`KernelClient.execute_many`."""
+        codes = list(codes)
+        sent: List[Tuple[str, "asyncio.Queue[Any]"]] = []
+        if not stop_on_error:
+            sent = [await self._send(code, stop_on_error) for code in codes]
+        try:
+            for i, code in enumerate(codes):
+                if stop_on_error:
+                    sent.append(await self._send(code))
+                msg_id, queue = sent[i]
+                output, execution = await self._collect(
+                    msg_id, queue, timeout, interrupt
+                )
+                yield output
+                if execution.died or (stop_on_error and execution.failed):
+                    return
+        finally:
+            for msg_id, _ in sent:
+                self._queues.pop(msg_id, None)
+
+    async def stream(
+        self,
+        code: str,
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> AsyncIterator[CodeBoxOutput]:
+        """Async version of :meth:`KernelClient.stream`."""
+        msg_id, queue = await self._send(code)
+        try:
+            async for received_msg in self._replies(
+                msg_id, queue, timeout, interrupt
+            ):
+                if (event := output_event(received_msg)) is not None:
+                    yield event
+                if is_idle(received_msg) or kernel_died(received_msg):
+                    return
+        except TimeoutError:
+            raise KernelUnresponsive(_timeout_output(timeout)) from None
+        except KernelClosed:
+            yield aborted_output()
+        finally:
+            self._queues.pop(msg_id, None)
+
+    async def _collect(
+        self,
+        msg_id: str,
+        queue: "asyncio.Queue[Any]",
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Tuple[CodeBoxOutput, Execution]:
+        execution = Execution()
+        replies = self._replies(msg_id, queue, timeout, interrupt)
+        try:
+            async for received_msg in replies:
+                if (output := execution.handle(received_msg)) is not None:
+                    return output, execution
+        except TimeoutError:
+            raise KernelUnresponsive(execution.result()) from None
+        except KernelClosed:
+            execution.aborted = True
+            return execution.result(), execution
+        finally:
+            await replies.aclose()
+        raise AssertionError("unreachable")
+
+    async def _replies(
+        self,
+        msg_id: str,
+        queue: "asyncio.Queue[Any]",
+        timeout: Optional[float] = None,
+        interrupt: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> AsyncIterator[dict]:
+        """Async version of :meth:`KernelClient._replies`.
+
+        The timeout starts with the first message, once the kernel started
+        the execution instead of while it is still queued behind others.
+        """
+        deadline: Optional[float] = None
+        interrupted = False
+        while True:
+            try:
+                received_msg = await asyncio.wait_for(
+                    self._next(queue), remaining(deadline)
+                )
+            except asyncio.TimeoutError:
+                if interrupted:
+                    raise TimeoutError from None
+                assert timeout is not None
+                yield timeout_message(msg_id, timeout)
+                if interrupt is not None:
+                    await interrupt()
+                interrupted = True
+                deadline = time.monotonic() + settings.INTERRUPT_TIMEOUT
+                continue
+            if deadline is None and timeout is not None:
+                deadline = time.monotonic() + timeout
+            yield received_msg
+
+    async def _send(
+        self, code: str, stop_on_error: bool = True
+    ) -> Tuple[str, "asyncio.Queue[Any]"]:
+        msg_id = uuid4().hex
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        self._queues[msg_id] = queue
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+        try:
+            await self.ws.send(execute_request(code, msg_id, stop_on_error))
+        except BaseException:
+            self._queues.pop(msg_id, None)
+            raise
+        return msg_id, queue
+
+    @staticmethod
+    async def _next(queue: "asyncio.Queue[Any]") -> dict:
+        item = await queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                received_msg = deserialize(await self.ws.recv())
+                self.liveness.observe(received_msg)
+                if kernel_died(received_msg):
+                    for queue in self._queues.values():
+                        queue.put_nowait(received_msg)
+                    continue
+                parent_id = received_msg["parent_header"].get("msg_id")
+                if (queue := self._queues.get(parent_id)) is not None:
+                    queue.put_nowait(received_msg)
+        except Exception as e:
+            # the websocket closed or sent garbage, fail all waiting calls
+            self.liveness.lost()
+            for queue in self._queues.values():
+                queue.put_nowait(e)
+
+    async def close(self) -> None:
+        """Stop reading and close the websocket.
+
+        Executions still waiting for their output are ``aborted``.
+        """
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        for queue in self._queues.values():
+            queue.put_nowait(KernelClosed("Kernel connection was closed"))
+        await self.ws.close()
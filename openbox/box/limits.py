@@ -0,0 +1,230 @@
+"""Resource limits of the DockerBox containers.
+
+Without limits a single session can take all memory, CPU time and processes
+of the host. The limits are enforced by docker through the cgroup of the
+container. OOM kills are followed on the docker events stream, the cgroup
+counters of all limits can be read back on request.
+"""
+
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import docker
+from requests.exceptions import RequestException  # type: ignore
+
+from openbox.config import settings
+
+# cgroup v2 and v1 files of the container with the counters of limit hits,
+# mapped to the event reported once the counter increased
+LIMIT_COUNTERS = {
+    ("/sys/fs/cgroup/memory.events", "oom_kill"): "oom_killed",
+    ("/sys/fs/cgroup/memory/memory.oom_control", "oom_kill"): "oom_killed",
+    ("/sys/fs/cgroup/cpu.stat", "nr_throttled"): "cpu_throttled",
+    ("/sys/fs/cgroup/cpu/cpu.stat", "nr_throttled"): "cpu_throttled",
+    ("/sys/fs/cgroup/pids.events", "max"): "pids_limit_reached",
+    ("/sys/fs/cgroup/pids/pids.events", "max"): "pids_limit_reached",
+}
+_COUNTER_FILES = sorted({path for path, _ in LIMIT_COUNTERS})
+# container events of the docker events stream mapped to their limit event
+DOCKER_EVENTS = {"oom": "oom_killed"}
+
+_cpuset_lock = threading.Lock()
+_next_cpu = 0
+_host_cpus: Dict[str, int] = {}
+_watchers_lock = threading.Lock()
+_watchers: Dict[str, "LimitWatcher"] = {}
+
+
+class ResourceLimits:
+    """Memory, CPU and process limits of a container.
+
+    ``mem_limit`` takes bytes or a docker size like ``"512m"`` and also caps
+    the swap, ``cpus`` the number of CPUs worth of time the container may
+    use and ``pids_limit`` the number of processes. With ``cpuset_size``
+    every container is pinned to that many cores, assigned round-robin so
+    the sessions are spread over all cores of the host. Unset limits default
+    to the CONTAINER_* settings.
+    """
+
+    def __init__(
+        self,
+        mem_limit: Union[int, str, None] = None,
+        cpus: Optional[float] = None,
+        pids_limit: Optional[int] = None,
+        cpuset_size: Optional[int] = None,
+    ) -> None:
+        self.mem_limit = (
+            settings.CONTAINER_MEM_LIMIT if mem_limit is None else mem_limit
+        )
+        self.cpus = settings.CONTAINER_CPUS if cpus is None else cpus
+        self.pids_limit = (
+            settings.CONTAINER_PIDS_LIMIT if pids_limit is None else pids_limit
+        )
+        self.cpuset_size = (
+            settings.CONTAINER_CPUSET_SIZE
+            if cpuset_size is None
+            else cpuset_size
+        )
+
+    def run_options(
+        self, docker_client: docker.DockerClient
+    ) -> Dict[str, Any]:
+        """Return the options for ``containers.run`` enforcing the limits."""
+        options: Dict[str, Any] = {}
+        if self.mem_limit:
+            options["mem_limit"] = options["memswap_limit"] = self.mem_limit
+        if self.cpus:
+            options["nano_cpus"] = int(self.cpus * 1e9)
+        if self.pids_limit:
+            options["pids_limit"] = self.pids_limit
+        if self.cpuset_size:
+            options["cpuset_cpus"] = next_cpuset(
+                host_cpus(docker_client), self.cpuset_size
+            )
+        return options
+
+    def _key(self) -> tuple:
+        return (self.mem_limit, self.cpus, self.pids_limit, self.cpuset_size)
+
+    def __bool__(self) -> bool:
+        return any(self._key())
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ResourceLimits):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} mem_limit={self.mem_limit} "
+            f"cpus={self.cpus} pids_limit={self.pids_limit} "
+            f"cpuset_size={self.cpuset_size}>"
+        )
+
+
+def host_cpus(docker_client: docker.DockerClient) -> int:
+    """Return the number of CPUs of the docker host, asked once per host."""
+    base_url = docker_client.api.base_url
+    if base_url not in _host_cpus:
+        _host_cpus[base_url] = int(docker_client.info()["NCPU"])
+    return _host_cpus[base_url]
+
+
+def next_cpuset(cpus: int, size: int) -> str:
+    """Return the next ``size`` of ``cpus`` cores in round-robin order."""
+    global _next_cpu
+    size = min(size, cpus)
+    with _cpuset_lock:
+        start = _next_cpu
+        _next_cpu = (start + size) % cpus
+    return ",".join(str((start + i) % cpus) for i in range(size))
+
+
+class LimitWatcher:
+    """Counts the limit events of all containers of a docker host.
+
+    Reading the cgroup counters takes an exec in the container, too slow to
+    do for every execution. Docker pushes OOM kills as container events
+    instead, which a background thread counts per container id.
+    """
+
+    def __init__(self, docker_client: docker.DockerClient) -> None:
+        self.docker_client = docker_client
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Follow the events stream unless already following it.
+
+        Subscribes before returning, so no event after the call is missed.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            try:
+                events = self.docker_client.events(
+                    decode=True,
+                    filters={
+                        "type": "container",
+                        "event": list(DOCKER_EVENTS),
+                    },
+                )
+            except (docker.errors.DockerException, RequestException) as e:
+                # limits are still enforced, only not reported
+                if settings.VERBOSE:
+                    print(f"Failed to follow docker events: {e}")
+                return
+            self._thread = threading.Thread(
+                target=self._follow,
+                args=(events,),
+                name="openbox-limits",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def counters(self, container_id: str) -> Dict[str, int]:
+        """Return how often the container hit its limits so far."""
+        with self._lock:
+            return dict(self._counters.get(container_id, {}))
+
+    def forget(self, container_id: str) -> None:
+        """Drop the counters of a removed container."""
+        with self._lock:
+            self._counters.pop(container_id, None)
+
+    def _follow(self, events: Iterator[Dict[str, Any]]) -> None:
+        try:
+            for event in events:
+                name = DOCKER_EVENTS.get(event.get("Action", ""))
+                container_id = event.get("Actor", {}).get("ID")
+                if name is None or container_id is None:
+                    continue
+                with self._lock:
+                    counters = self._counters.setdefault(container_id, {})
+                    counters[name] = counters.get(name, 0) + 1
+        except Exception as e:
+            # the stream broke, the next start follows a new one
+            if settings.VERBOSE:
+                print(f"Stopped following docker events: {e}")
+
+
+def limit_watcher(docker_client: docker.DockerClient) -> LimitWatcher:
+    """Return the watcher of the docker host, one per host.
+
+    Never blocks, the watcher only counts events once it was started.
+    """
+    base_url = docker_client.api.base_url
+    with _watchers_lock:
+        if (watcher := _watchers.get(base_url)) is None:
+            watcher = _watchers[base_url] = LimitWatcher(docker_client)
+    return watcher
+
+
+def read_limit_counters(
+    container: docker.models.containers.Container,
+) -> Dict[str, int]:
+    """Read how often the limits of the container were hit so far.
+
+    Returns the counters by event, empty if the container is not running.
+    Runs a command in the container, so it is only done on request.
+    """
+    try:
+        # prints every line prefixed with its file, skips missing files
+        result = container.exec_run(["grep", "-sH", "", *_COUNTER_FILES])
+    except docker.errors.APIError:
+        return {}
+    counters: Dict[str, int] = {}
+    for line in result.output.decode(errors="replace").splitlines():
+        path, _, counter = line.partition(":")
+        key, _, value = counter.partition(" ")
+        if (event := LIMIT_COUNTERS.get((path, key))) and value.isdigit():
+            counters[event] = int(value)
+    return counters
+
+
+def limit_events(before: Dict[str, int], after: Dict[str, int]) -> List[str]:
+    """Return the events whose counters increased in between."""
+    return [
+        event for event, count in after.items() if count > before.get(event, 0)
+    ]
@@ -0,0 +1,84 @@
+"""Kernel code to install python packages into a CodeBox.
+
+Checking which packages are installed and installing the missing ones is
+done inside the kernel, so it works for every CodeBox implementation. The
+check only reads the package metadata and doesn't import anything.
+"""
+
+import json
+import shlex
+from typing import Dict, Sequence
+
+from openbox.schema import CodeBoxOutput, CodeBoxStatus
+
+# executed in a fresh namespace to not leak names into the session
+_INSTALLED_CODE = """
+import json
+from importlib.metadata import PackageNotFoundError, version
+try:
+    from packaging.requirements import Requirement
+except ImportError:
+    from pip._vendor.packaging.requirements import Requirement
+installed = {}
+for spec in specs:
+    try:
+        requirement = Requirement(spec)
+        installed[spec] = requirement.specifier.contains(
+            version(requirement.name), prereleases=True
+        )
+    except (PackageNotFoundError, ValueError):
+        installed[spec] = False
+print(json.dumps(installed))
+"""
+
+
+def installed_code(packages: Sequence[str]) -> str:
+    """Return kernel code printing which requirements are satisfied."""
+    return f"exec({_INSTALLED_CODE!r}, {{'specs': {list(packages)!r}}})"
+
+
+def pip_install_code(packages: Sequence[str]) -> str:
+    """Return kernel code installing all packages with one pip call.
+
+    The requirements are checked again after the installation, so the
+    output can be passed to :func:`parse_installed` to see what failed.
+    """
+    return (
+        f"!pip install -q {' '.join(shlex.quote(p) for p in packages)}\n"
+        "import importlib; importlib.invalidate_caches()\n"
+        + installed_code(packages)
+    )
+
+
+def parse_installed(output: CodeBoxOutput) -> Dict[str, bool]:
+    """Read the result of :func:`installed_code` from the kernel output."""
+    stdout = "".join(o.content for o in output.outputs if o.type == "stdout")
+    for line in reversed(stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    return {}
+
+
+def install_status(
+    packages: Sequence[str],
+    installed: Dict[str, bool],
+    now_installed: Dict[str, bool],
+) -> Dict[str, CodeBoxStatus]:
+    """Combine the checks before and after installing into a status each."""
+    statuses = {}
+    for package in packages:
+        if installed.get(package):
+            status = "already installed"
+        elif now_installed.get(package):
+            status = "installed"
+        else:
+            status = "failed"
+        statuses[package] = CodeBoxStatus(status=status)
+    return statuses
+
+
+def install_message(package: str, status: CodeBoxStatus) -> CodeBoxStatus:
+    """Turn the status of a single package into a message for install."""
+    if status == "failed":
+        return CodeBoxStatus(status=f"{package} failed to install")
+    return CodeBoxStatus(status=f"{package} installed successfully")
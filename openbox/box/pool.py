@@ -0,0 +1,291 @@
+"""Pool of pre-warmed DockerBox containers.
+
+Cold starting a DockerBox runs a new container, waits for the kernel gateway
+inside of it and then creates a kernel. The pool does all of this ahead of
+time in a background thread, so ``DockerBox.start`` only has to check out a
+warm container and connect to its kernel.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Sequence
+from uuid import UUID, uuid4
+
+import docker
+import requests  # type: ignore
+
+from openbox.box.docker import (
+    DOCKER_IMAGE,
+    published_port,
+    resolve_image,
+    run_gateway_container,
+)
+from openbox.box.limits import ResourceLimits
+from openbox.box.utils import wait_for_gateway
+from openbox.config import settings
+
+
+class WarmKernel:
+    """A running container with a ready kernel gateway and kernel."""
+
+    def __init__(
+        self,
+        session_id: UUID,
+        container: docker.models.containers.Container,
+        port: int,
+        kernel_id: str,
+        image: str = DOCKER_IMAGE,
+    ) -> None:
+        self.session_id = session_id
+        self.container = container
+        self.port = port
+        self.kernel_id = kernel_id
+        self.image = image
+        self.created_at = self.last_checked = time.time()
+
+    @property
+    def kernel_url(self) -> str:
+        """Return the url of the kernel."""
+        return f"http://localhost:{self.port}/api"
+
+    def __repr__(self) -> str:
+        return f"<WarmKernel id={self.session_id} port={self.port}>"
+
+
+class DockerBoxPool:
+    """Keeps DockerBox containers warm so sessions start instantly.
+
+    The pool tries to keep ``min_size`` warm containers around. Every
+    checkout that finds the pool empty raises the target by one, up to
+    ``max_size``, and warm containers which stay unused for longer than
+    ``idle_ttl`` seconds are retired until the pool is back at ``min_size``.
+    Warm containers are health checked every ``health_check_interval``
+    seconds and replaced when their kernel stopped responding.
+
+    With ``packages`` the pool starts its containers from the image derived
+    for these packages once a DockerBox built it, see
+    :meth:`DockerBox.install_many`. The containers are started with the
+    resource ``limits``, by default the ones configured in the settings.
+    """
+
+    def __init__(
+        self,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+        health_check_interval: Optional[float] = None,
+        image: str = DOCKER_IMAGE,
+        docker_client: Optional[docker.DockerClient] = None,
+        packages: Optional[Sequence[str]] = None,
+        limits: Optional[ResourceLimits] = None,
+    ) -> None:
+        self.min_size = (
+            settings.POOL_MIN_SIZE if min_size is None else min_size
+        )
+        self.max_size = (
+            settings.POOL_MAX_SIZE if max_size is None else max_size
+        )
+        self.idle_ttl = (
+            settings.POOL_IDLE_TTL if idle_ttl is None else idle_ttl
+        )
+        self.health_check_interval = (
+            settings.POOL_HEALTH_CHECK_INTERVAL
+            if health_check_interval is None
+            else health_check_interval
+        )
+        if not 0 <= self.min_size <= self.max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min <= max")
+
+        self.image = image
+        self.packages = list(packages or [])
+        self.limits = ResourceLimits() if limits is None else limits
+        self.docker_client = docker_client or docker.from_env()
+        self.http_session = requests.Session()
+        self.hits = 0
+        self.misses = 0
+        self._target = self.min_size
+        self._warm: Deque[WarmKernel] = deque()
+        self._spawning = 0
+        self._lock = threading.Condition()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the background thread which keeps the pool filled."""
+        if self._thread is not None:
+            return
+        self._closed.clear()
+        self._thread = threading.Thread(
+            target=self._maintain, name="openbox-pool", daemon=True
+        )
+        self._thread.start()
+
+    def checkout(self) -> Optional[WarmKernel]:
+        """Take a warm container out of the pool.
+
+        Returns ``None`` when the pool is empty, the caller is then expected
+        to cold start its own container. Containers which turn out to be
+        broken are handed back with :meth:`discard`.
+        """
+        with self._lock:
+            if self._warm:
+                warm = self._warm.popleft()
+                self.hits += 1
+            else:
+                warm = None
+                self.misses += 1
+                self._target = min(self._target + 1, self.max_size)
+            self._lock.notify_all()
+        return warm
+
+    def discard(self, warm: WarmKernel) -> None:
+        """Remove a checked out container which turned out to be broken.
+
+        The pool warms up a replacement for it in the background.
+        """
+        self._discard(warm)
+        with self._lock:
+            self._lock.notify_all()
+
+    def stop(self) -> None:
+        """Stop the refill thread and remove all warm containers."""
+        self._closed.set()
+        with self._lock:
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            warm, self._warm = list(self._warm), deque()
+        for entry in warm:
+            self._discard(entry)
+        self.http_session.close()
+
+    def _maintain(self) -> None:
+        last_health_check = time.time()
+        while not self._closed.is_set():
+            self._retire_idle()
+            if time.time() - last_health_check >= self.health_check_interval:
+                self._check_health()
+                last_health_check = time.time()
+
+            with self._lock:
+                missing = self._target - len(self._warm) - self._spawning
+                if missing <= 0:
+                    self._lock.wait(timeout=self._next_wakeup())
+                    continue
+                self._spawning += 1
+
+            try:
+                warm = self._spawn()
+            except Exception as e:
+                if settings.VERBOSE:
+                    print(f"Failed to warm up container: {e}")
+                self._closed.wait(1)
+                continue
+            finally:
+                with self._lock:
+                    self._spawning -= 1
+
+            with self._lock:
+                closed = self._closed.is_set()
+                if not closed:
+                    self._warm.append(warm)
+            if closed:
+                self._discard(warm)
+
+    def _next_wakeup(self) -> float:
+        wakeup = self.health_check_interval
+        if self._warm and len(self._warm) > self.min_size:
+            age = time.time() - self._warm[0].created_at
+            wakeup = min(wakeup, max(self.idle_ttl - age, 0))
+        return max(wakeup, 0.1)
+
+    def _retire_idle(self) -> None:
+        retired: List[WarmKernel] = []
+        with self._lock:
+            now = time.time()
+            while (
+                len(self._warm) > self.min_size
+                and now - self._warm[0].created_at > self.idle_ttl
+            ):
+                retired.append(self._warm.popleft())
+            if retired:
+                self._target = max(len(self._warm), self.min_size)
+        for warm in retired:
+            self._discard(warm)
+
+    def _check_health(self) -> None:
+        with self._lock:
+            warm = list(self._warm)
+        for entry in warm:
+            try:
+                response = self.http_session.get(
+                    f"{entry.kernel_url}/kernels/{entry.kernel_id}", timeout=5
+                )
+                healthy = response.status_code == 200
+            except requests.exceptions.RequestException:
+                healthy = False
+            entry.last_checked = time.time()
+            if healthy:
+                continue
+            with self._lock:
+                try:
+                    self._warm.remove(entry)
+                except ValueError:
+                    continue
+            self._discard(entry)
+
+    def _spawn(self) -> WarmKernel:
+        session_id = uuid4()
+        image = resolve_image(self.docker_client, self.image, self.packages)
+        container = run_gateway_container(
+            self.docker_client, session_id, image, self.limits
+        )
+        try:
+            port = published_port(container)
+            kernel_url = f"http://localhost:{port}/api"
+            wait_for_gateway(
+                kernel_url,
+                is_alive=lambda: _running(container),
+                session=self.http_session,
+            )
+            response = self.http_session.post(
+                f"{kernel_url}/kernels",
+                headers={"Content-Type": "application/json"},
+                timeout=270,
+            )
+            kernel_id = response.json()["id"]
+        except Exception:
+            container.remove(force=True)
+            raise
+
+        return WarmKernel(session_id, container, port, kernel_id, image)
+
+    def _discard(self, warm: WarmKernel) -> None:
+        try:
+            warm.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self._warm)
+
+    def __enter__(self) -> "DockerBoxPool":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} warm={len(self._warm)} "
+            f"min={self.min_size} max={self.max_size}>"
+        )
+
+
+def _running(container: docker.models.containers.Container) -> bool:
+    container.reload()
+    return container.status in ("created", "running")
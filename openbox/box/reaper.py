@@ -0,0 +1,160 @@
+"""Reaper for CodeBox sessions which are no longer used.
+
+Every started session keeps its container or kernel running until it is
+stopped. The reaper checks the session registry in a background thread and
+stops sessions which were idle for longer than ``idle_ttl`` seconds. With
+``max_sessions`` it also caps the number of live sessions and evicts the
+least recently used ones when more are started. Sessions executing code
+are left alone. Reaped sessions are always stopped, their containers are
+never handed to the next session, a DockerBoxPool warms up new ones.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+from openbox.box.base import BaseBox
+from openbox.box.registry import SessionRegistry, sessions
+from openbox.config import settings
+
+
+class SessionReaper:
+    """Stops idle sessions and enforces a cap on the live sessions.
+
+    The time a session was last used is its ``last_interaction``, sessions
+    which are ``busy`` executing code are never reaped. Reaped sessions are
+    counted in ``reaped`` when they were idle and in ``evicted`` when they
+    were over the cap.
+    """
+
+    def __init__(
+        self,
+        idle_ttl: Optional[float] = None,
+        max_sessions: Optional[int] = None,
+        interval: Optional[float] = None,
+        registry: SessionRegistry = sessions,
+    ) -> None:
+        self.idle_ttl = (
+            settings.REAPER_IDLE_TTL if idle_ttl is None else idle_ttl
+        )
+        self.max_sessions = (
+            settings.REAPER_MAX_SESSIONS
+            if max_sessions is None
+            else max_sessions
+        )
+        self.interval = (
+            settings.REAPER_INTERVAL if interval is None else interval
+        )
+        if self.max_sessions is not None and self.max_sessions < 0:
+            raise ValueError("max_sessions must not be negative")
+
+        self.registry = registry
+        self.reaped = 0
+        self.evicted = 0
+        self.failed = 0
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start reaping sessions in a background thread."""
+        if self._thread is not None:
+            return
+        self._closed.clear()
+        self.registry.subscribe(self._registered)
+        self._thread = threading.Thread(
+            target=self._run, name="openbox-reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread, the sessions keep running."""
+        self._closed.set()
+        self._wakeup.set()
+        self.registry.unsubscribe(self._registered)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reap(self) -> int:
+        """Reap idle sessions and evict sessions over the cap once.
+
+        Returns the number of sessions which were reaped or evicted.
+        """
+        now = time.time()
+        idle: List[BaseBox] = []
+        active: List[BaseBox] = []
+        busy = 0
+        for box in sorted(self.registry.list(), key=_last_used):
+            if box.busy:
+                busy += 1
+            elif now - _last_used(box) > self.idle_ttl:
+                idle.append(box)
+            else:
+                active.append(box)
+        evict: List[BaseBox] = []
+        if self.max_sessions is not None:
+            over = len(active) + busy - self.max_sessions
+            evict = active[: max(over, 0)]
+
+        for box in idle:
+            self._release(box)
+            self.reaped += 1
+        for box in evict:
+            self._release(box)
+            self.evicted += 1
+        return len(idle) + len(evict)
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        """Return the number of live and reaped sessions."""
+        return {
+            "live": len(self.registry),
+            "reaped": self.reaped,
+            "evicted": self.evicted,
+            "failed": self.failed,
+        }
+
+    def _run(self) -> None:
+        while not self._closed.is_set():
+            self._wakeup.clear()
+            try:
+                self.reap()
+            except Exception as e:
+                if settings.VERBOSE:
+                    print(f"Failed to reap sessions: {e}")
+            self._wakeup.wait(self.interval)
+
+    def _registered(self, box: BaseBox) -> None:
+        if (
+            self.max_sessions is not None
+            and len(self.registry) > self.max_sessions
+        ):
+            self._wakeup.set()
+
+    def _release(self, box: BaseBox) -> None:
+        try:
+            box.stop()
+        except Exception as e:
+            # the box is unusable either way, don't try again every tick
+            self.failed += 1
+            self.registry.unregister(box)
+            if settings.VERBOSE:
+                print(f"Failed to stop session {box.session_id}: {e}")
+
+    def __enter__(self) -> "SessionReaper":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} live={len(self.registry)} "
+            f"reaped={self.reaped} evicted={self.evicted}>"
+        )
+
+
+def _last_used(box: BaseBox) -> float:
+    return box.last_interaction.timestamp()
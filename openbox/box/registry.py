@@ -0,0 +1,81 @@
+"""Registry of the CodeBox sessions running in this process."""
+
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+from uuid import UUID
+
+if TYPE_CHECKING:
+    from openbox.box.base import BaseBox
+
+
+class SessionRegistry:
+    """Keeps track of all started CodeBox instances by their session_id."""
+
+    def __init__(self) -> None:
+        self._sessions: Dict[UUID, "BaseBox"] = {}
+        self._listeners: List[Callable[["BaseBox"], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, box: "BaseBox") -> None:
+        """Add a started CodeBox to the registry."""
+        if box.session_id is None:
+            raise ValueError("Only started sessions can be registered")
+        with self._lock:
+            self._sessions[_as_uuid(box.session_id)] = box
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(box)
+
+    def unregister(self, box: "BaseBox") -> None:
+        """Remove a CodeBox from the registry if it is registered."""
+        if box.session_id is None:
+            return
+        with self._lock:
+            session_id = _as_uuid(box.session_id)
+            if self._sessions.get(session_id) is box:
+                del self._sessions[session_id]
+
+    def subscribe(self, listener: Callable[["BaseBox"], None]) -> None:
+        """Call listener with every CodeBox registered from now on."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[["BaseBox"], None]) -> None:
+        """Stop calling a listener added with subscribe."""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def get(self, session_id: Union[UUID, str]) -> Optional["BaseBox"]:
+        """Return the CodeBox with the given session_id if it is running."""
+        with self._lock:
+            return self._sessions.get(_as_uuid(session_id))
+
+    def list(self) -> List["BaseBox"]:
+        """Return a snapshot of all registered CodeBox instances."""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def __contains__(self, session_id: Union[UUID, str]) -> bool:
+        return self.get(session_id) is not None
+
+    def __iter__(self) -> Iterator["BaseBox"]:
+        return iter(self.list())
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+def _as_uuid(session_id: Union[UUID, str]) -> UUID:
+    return session_id if isinstance(session_id, UUID) else UUID(session_id)
+
+
+sessions = SessionRegistry()
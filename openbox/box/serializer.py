@@ -0,0 +1,94 @@
+"""JSON serializers for the kernel messages.
+
+The messages are encoded with the fastest JSON library installed, orjson or
+msgspec, falling back to the standard library. Set ``JSON_SERIALIZER`` to
+pick one explicitly.
+"""
+
+import json
+from functools import lru_cache
+from typing import Any, Dict, Optional, Type, Union
+
+from openbox.config import settings
+
+
+class Serializer:
+    """Encodes and decodes JSON with the standard library."""
+
+    name = "json"
+
+    def dumps(self, obj: Any) -> str:
+        """Encode obj as a JSON string, to be sent as websocket text frame."""
+        return json.dumps(obj)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """Decode a JSON string or UTF-8 encoded bytes."""
+        return json.loads(data)
+
+
+class OrjsonSerializer(Serializer):
+    name = "orjson"
+
+    def __init__(self) -> None:
+        import orjson
+
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+
+    def dumps(self, obj: Any) -> str:
+        return self._dumps(obj).decode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return self._loads(data)
+
+
+class MsgspecSerializer(Serializer):
+    name = "msgspec"
+
+    def __init__(self) -> None:
+        import msgspec
+
+        self._encode = msgspec.json.Encoder().encode
+        self._decode = msgspec.json.Decoder().decode
+
+    def dumps(self, obj: Any) -> str:
+        return self._encode(obj).decode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return self._decode(data)
+
+
+# in order of preference
+SERIALIZERS: Dict[str, Type[Serializer]] = {
+    "orjson": OrjsonSerializer,
+    "msgspec": MsgspecSerializer,
+    "json": Serializer,
+}
+
+
+@lru_cache(maxsize=None)
+def get_serializer(name: Optional[str] = None) -> Serializer:
+    """Return the serializer of the given name or the fastest installed.
+
+    Raises ValueError for unknown names and ImportError if the library of
+    the requested serializer is not installed.
+    """
+    if name is not None:
+        try:
+            return SERIALIZERS[name]()
+        except KeyError:
+            raise ValueError(
+                f"Unknown JSON serializer {name!r}, "
+                f"use one of {', '.join(SERIALIZERS)}"
+            ) from None
+    for serializer in SERIALIZERS.values():
+        try:
+            return serializer()
+        except ImportError:
+            pass
+    return Serializer()
+
+
+def serializer() -> Serializer:
+    """Return the serializer configured by ``JSON_SERIALIZER``."""
+    return get_serializer(settings.JSON_SERIALIZER)
@@ -0,0 +1,97 @@
+"""Helpers shared by the kernel gateway based CodeBox implementations."""
+
+import asyncio
+import socket
+import time
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+import requests  # type: ignore
+
+from openbox.config import settings
+
+
+def free_port() -> int:
+    """Return a free local port picked by the operating system."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_gateway(
+    url: str,
+    timeout: Optional[float] = None,
+    is_alive: Optional[Callable[[], bool]] = None,
+    session: Optional[requests.Session] = None,
+) -> float:
+    """Block until the kernel gateway at url answers with 200.
+
+    Probes with an exponential backoff so a gateway which comes up is
+    detected within milliseconds. ``is_alive`` is consulted once the backoff
+    reached its maximum interval to fail fast when the gateway process died.
+    Raises TimeoutError when the gateway is not ready before the deadline and
+    returns the time it took to become ready in seconds. Pass the session of
+    the caller to keep its connection to the gateway alive.
+    """
+    http = session or requests.Session()
+    started = time.monotonic()
+    deadline = started + (
+        settings.KERNEL_START_TIMEOUT if timeout is None else timeout
+    )
+    interval = settings.KERNEL_PROBE_INTERVAL
+    while True:
+        try:
+            response = http.get(
+                url, timeout=max(deadline - time.monotonic(), 0.001)
+            )
+            if response.status_code == 200:
+                return time.monotonic() - started
+        except requests.exceptions.RequestException:
+            pass
+        if interval >= settings.KERNEL_PROBE_MAX_INTERVAL and is_alive:
+            if not is_alive():
+                raise RuntimeError(f"Kernel gateway at {url} exited")
+        if settings.VERBOSE:
+            print("Waiting for kernel to start...")
+        time.sleep(_backoff(interval, url, deadline))
+        interval = min(interval * 2, settings.KERNEL_PROBE_MAX_INTERVAL)
+
+
+async def await_for_gateway(
+    url: str,
+    session: aiohttp.ClientSession,
+    timeout: Optional[float] = None,
+    is_alive: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> float:
+    """Async version of :func:`wait_for_gateway`."""
+    started = time.monotonic()
+    deadline = started + (
+        settings.KERNEL_START_TIMEOUT if timeout is None else timeout
+    )
+    interval = settings.KERNEL_PROBE_INTERVAL
+    while True:
+        try:
+            async with session.get(
+                url,
+                timeout=aiohttp.ClientTimeout(
+                    total=max(deadline - time.monotonic(), 0.001)
+                ),
+            ) as response:
+                if response.status == 200:
+                    return time.monotonic() - started
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        if interval >= settings.KERNEL_PROBE_MAX_INTERVAL and is_alive:
+            if not await is_alive():
+                raise RuntimeError(f"Kernel gateway at {url} exited")
+        if settings.VERBOSE:
+            print("Waiting for kernel to start...")
+        await asyncio.sleep(_backoff(interval, url, deadline))
+        interval = min(interval * 2, settings.KERNEL_PROBE_MAX_INTERVAL)
+
+
+def _backoff(interval: float, url: str, deadline: float) -> float:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"Kernel gateway at {url} did not become ready")
+    return min(interval, remaining)
@@ -3,6 +3,8 @@ CodeBox API Config:
 Automatically loads environment variables from .env file
 """
 
+from typing import Optional
+
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -18,5 +20,52 @@ class CodeBoxSettings(BaseSettings):
     VERBOSE: bool = False
     SHOW_INFO: bool = True
 
+    # Kernel gateway startup
+    KERNEL_START_TIMEOUT: float = 60.0
+    KERNEL_PROBE_INTERVAL: float = 0.005
+    KERNEL_PROBE_MAX_INTERVAL: float = 0.5
+
+    # DockerBoxPool
+    POOL_MIN_SIZE: int = 1
+    POOL_MAX_SIZE: int = 4
+    POOL_IDLE_TTL: float = 600.0
+    POOL_HEALTH_CHECK_INTERVAL: float = 30.0
+
+    # Default timeout of run/arun in seconds, the kernel is interrupted
+    # after it and restarted if it is still busy INTERRUPT_TIMEOUT later
+    RUN_TIMEOUT: Optional[float] = None
+    INTERRUPT_TIMEOUT: float = 5.0
+
+    # DockerBox resource limits per container, unlimited if unset
+    CONTAINER_MEM_LIMIT: Optional[str] = None
+    CONTAINER_CPUS: Optional[float] = None
+    CONTAINER_PIDS_LIMIT: Optional[int] = None
+    CONTAINER_CPUSET_SIZE: Optional[int] = None
+
+    # SessionReaper, sessions idle for REAPER_IDLE_TTL seconds are stopped
+    REAPER_IDLE_TTL: float = 1800.0
+    REAPER_MAX_SESSIONS: Optional[int] = None
+    REAPER_INTERVAL: float = 10.0
+
+    # Cached status, refreshed when older than STATUS_MAX_AGE seconds
+    STATUS_MAX_AGE: float = 5.0
+    STATUS_TIMEOUT: float = 5.0
+
+    # Text output of run/arun, summarized by its first OUTPUT_HEAD and last
+    # OUTPUT_TAIL characters. Stream outputs are dropped once an execution
+    # printed OUTPUT_MAX_SIZE characters, unless unset. With OUTPUT_SPILL
+    # the full text is written to a temp file, see CodeBoxOutput.log_file
+    OUTPUT_HEAD: int = 0
+    OUTPUT_TAIL: int = 500
+    OUTPUT_MAX_SIZE: Optional[int] = 16 * 1024 * 1024
+    OUTPUT_SPILL: bool = False
+
+    # JSON library of the kernel messages: orjson, msgspec or json,
+    # by default the fastest installed
+    JSON_SERIALIZER: Optional[str] = None
+
+    # DockerBox packages, host directory shared as pip cache by containers
+    PIP_CACHE_DIR: Optional[str] = None
+
 
 settings = CodeBoxSettings()
@@ -4,9 +4,10 @@ It is used to validate the data returned from the API. It also helps with type
 hinting and provides a nice interface for interacting with the API.
 """
 
-from typing import Optional
+import base64
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 
 class CodeBoxStatus(BaseModel):
@@ -25,10 +26,68 @@ class CodeBoxStatus(BaseModel):
 
 
 class CodeBoxOutput(BaseModel):
-    """Represents the code execution output of a CodeBox instance."""
+    """Represents the code execution output of a CodeBox instance.
+
+    Binary content like images is sent base64 encoded by the kernel, use
+    :meth:`as_bytes` or :meth:`as_memoryview` to get the decoded bytes.
+
+    ``events`` reports resource limits hit during the execution, so far
+    only ``oom_killed``. CPU throttling and the pids limit are not
+    reported, see ``DockerBox.limit_counters``.
+
+    ``truncated`` tells if printed text was left out of ``content`` or
+    ``outputs`` to bound the memory, see the OUTPUT_* settings. If the
+    output was spilled, ``log_file`` is the path of the full text.
+    """
 
     type: str
     content: str
+    data: Optional[Dict[str, Any]] = None
+    outputs: List["CodeBoxOutput"] = []
+    events: List[str] = []
+    truncated: bool = False
+    log_file: Optional[str] = None
+
+    _decoded: Dict[str, bytes] = PrivateAttr(default_factory=dict)
+    _buffers: List[memoryview] = PrivateAttr(default_factory=list)
+
+    def as_bytes(self, mime_type: Optional[str] = None) -> bytes:
+        """Return the decoded bytes of base64 encoded content.
+
+        Defaults to the type of the output itself, e.g. ``image/png``. The
+        content is decoded on first access only and cached afterwards.
+        """
+        mime_type = mime_type or self.type
+        if (decoded := self._decoded.get(mime_type)) is None:
+            if self.data and mime_type in self.data:
+                encoded = self.data[mime_type]
+            elif mime_type == self.type:
+                encoded = self.content
+            else:
+                raise KeyError(f"Output has no {mime_type} content")
+            decoded = self._decoded[mime_type] = base64.b64decode(encoded)
+        return decoded
+
+    def as_memoryview(self, mime_type: Optional[str] = None) -> memoryview:
+        """Like :meth:`as_bytes` but returns a read-only view on the bytes."""
+        return memoryview(self.as_bytes(mime_type))
+
+    @property
+    def buffers(self) -> List[memoryview]:
+        """Binary buffers the kernel sent along with the output.
+
+        These are views into the received websocket frame, no copy is made.
+        """
+        return self._buffers
+
+    @property
+    def images(self) -> List[str]:
+        """All base64 encoded png images displayed by the execution."""
+        return [
+            output.data["image/png"]
+            for output in self.outputs
+            if output.data and "image/png" in output.data
+        ]
 
     def __str__(self):
         return self.content
@@ -0,0 +1,374 @@
+"""Benchmark the DockerBox lifecycle and execution latency.
+
+Runs against fake kernel gateways by default, so the numbers only depend on
+the client and are reproducible on any machine. Pass ``--docker`` to measure
+real containers instead. Every stage is measured in sync and async mode and
+reported as p50/p95/p99 in milliseconds, the results are written as JSON to
+track regressions::
+
+    python -m openbox.tests.benchmark --iterations 20 --output bench.json
+
+With ``--replay 100000`` it instead replays that many recorded kernel
+messages into the kernel clients, without any gateway, to measure the
+per-message overhead of the message handling.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List
+
+from openbox import DockerBox
+from openbox.box.kernel import AsyncKernelClient, KernelClient
+from openbox.schema import CodeBoxOutput
+from openbox.tests.fake_docker import FakeDockerClient
+from openbox.tests.fake_gateway import message
+
+Samples = Dict[str, List[float]]
+
+# the fake gateway provides display_png, define it for real kernels
+DISPLAY_PNG = """
+from IPython.display import Image, display
+def display_png(data):
+    display(Image(data=data, format="png"))
+"""
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+TRANSFER_STAGES = ("upload", "download")
+# msg_id of the recorded execution, replaced by the one of the request
+REPLAY_MSG_ID = "00000000000000000000000000replay"
+
+
+@contextmanager
+def measure(samples: Samples, stage: str) -> Iterator[None]:
+    """Record the time the block took as a sample of the stage."""
+    started = time.perf_counter()
+    yield
+    samples.setdefault(stage, []).append(time.perf_counter() - started)
+
+
+def percentile(ordered: List[float], percent: float) -> float:
+    """Return the percentile of sorted samples, interpolated linearly."""
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+        position - lower
+    )
+
+
+def summarize(samples: List[float], size: int = 0) -> Dict[str, float]:
+    """Return the sample count and latency percentiles in milliseconds.
+
+    Stages transferring ``size`` bytes also get their median throughput.
+    """
+    ordered = sorted(samples)
+    summary = {
+        "n": len(ordered),
+        "mean": 1000 * sum(ordered) / len(ordered),
+        "p50": 1000 * percentile(ordered, 50),
+        "p95": 1000 * percentile(ordered, 95),
+        "p99": 1000 * percentile(ordered, 99),
+        "max": 1000 * ordered[-1],
+    }
+    if size:
+        summary["mb_per_s"] = size / 1e6 / percentile(ordered, 50)
+    return summary
+
+
+class Workload:
+    """The code and files of one benchmark iteration."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.executes = args.executes
+        self.prelude = DISPLAY_PNG if args.docker else None
+        self.stdout_code = f"print('x' * {args.stdout_size})"
+        self.image_code = (
+            f"display_png({PNG_HEADER!r} + bytes({args.image_size}))"
+        )
+        self.file_name = "benchmark.bin"
+        self.file = bytes(args.file_size)
+
+
+def check(output: CodeBoxOutput, output_type: str = "text") -> None:
+    """Make sure the benchmark doesn't measure failing code."""
+    if output.type != output_type:
+        raise RuntimeError(f"Benchmark code failed: {output!r}")
+
+
+def run_sync(box: DockerBox, work: Workload, samples: Samples) -> None:
+    with measure(samples, "start"):
+        box.start()
+    try:
+        with measure(samples, "first_execute"):
+            check(box.run("pass"))
+        if work.prelude:
+            check(box.run(work.prelude))
+        for _ in range(work.executes):
+            with measure(samples, "execute"):
+                check(box.run("pass"))
+        with measure(samples, "execute_many"):
+            for output in box.run_many(
+                ["pass"] * work.executes, stop_on_error=False
+            ):
+                check(output)
+        with measure(samples, "large_stdout"):
+            check(box.run(work.stdout_code))
+        with measure(samples, "image"):
+            check(box.run(work.image_code), "image/png")
+        with measure(samples, "upload"):
+            box.upload(work.file_name, work.file)
+        with measure(samples, "download"):
+            box.download(work.file_name)
+    finally:
+        with measure(samples, "stop"):
+            box.stop()
+
+
+async def run_async(box: DockerBox, work: Workload, samples: Samples) -> None:
+    with measure(samples, "start"):
+        await box.astart()
+    try:
+        with measure(samples, "first_execute"):
+            check(await box.arun("pass"))
+        if work.prelude:
+            check(await box.arun(work.prelude))
+        for _ in range(work.executes):
+            with measure(samples, "execute"):
+                check(await box.arun("pass"))
+        with measure(samples, "execute_many"):
+            for output in await box.arun_many(
+                ["pass"] * work.executes, stop_on_error=False
+            ):
+                check(output)
+        with measure(samples, "large_stdout"):
+            check(await box.arun(work.stdout_code))
+        with measure(samples, "image"):
+            check(await box.arun(work.image_code), "image/png")
+        with measure(samples, "upload"):
+            await box.aupload(work.file_name, work.file)
+        with measure(samples, "download"):
+            await box.adownload(work.file_name)
+    finally:
+        with measure(samples, "stop"):
+            await box.astop()
+
+
+def replay_frames(count: int) -> List[str]:
+    """Record the frames of an execution sending count messages.
+
+    Mostly outputs of the execution, mixed with outputs of another
+    execution which the clients have to skip.
+    """
+    parent = {"msg_id": REPLAY_MSG_ID, "msg_type": "execute_request"}
+    other = {"msg_id": "other", "msg_type": "execute_request"}
+    line = {"name": "stdout", "text": "x" * 79 + "\n"}
+    data = {"data": {"text/plain": "42"}, "metadata": {}}
+    cycle = [
+        message("stream", parent, line),
+        message("stream", parent, dict(line, name="stderr")),
+        message("display_data", parent, data),
+        message("execute_result", parent, dict(data, execution_count=1)),
+        message("stream", other, line),
+    ]
+    first = message("status", parent, {"execution_state": "busy"})
+    last = [
+        message("execute_reply", parent, {"status": "ok"}, channel="shell"),
+        message("status", parent, {"execution_state": "idle"}),
+    ]
+    messages = [cycle[i % len(cycle)] for i in range(count - 1 - len(last))]
+    return [json.dumps(msg) for msg in [first, *messages, *last]]
+
+
+class ReplayConnection:
+    """A sync kernel websocket replaying recorded frames.
+
+    ``sent`` is the time the execute_request was sent, after which the
+    frames can be received.
+    """
+
+    def __init__(self, frames: List[str]) -> None:
+        self.frames = frames
+        self.sent = 0.0
+        self._replay: Iterator[str] = iter(())
+
+    def send(self, request: str) -> None:
+        msg_id = json.loads(request)["header"]["msg_id"]
+        self._replay = iter(
+            [frame.replace(REPLAY_MSG_ID, msg_id) for frame in self.frames]
+        )
+        self.sent = time.perf_counter()
+
+    def recv(self, timeout: Any = None) -> str:
+        return next(self._replay)
+
+
+class AsyncReplayConnection:
+    """Async version of :class:`ReplayConnection`."""
+
+    def __init__(self, frames: List[str]) -> None:
+        self._connection = ReplayConnection(frames)
+
+    @property
+    def sent(self) -> float:
+        return self._connection.sent
+
+    async def send(self, request: str) -> None:
+        self._connection.send(request)
+
+    async def recv(self) -> str:
+        try:
+            return self._connection.recv()
+        except StopIteration:
+            # like an open websocket without any more messages
+            await asyncio.Event().wait()
+            raise
+
+    async def close(self) -> None:
+        pass
+
+
+async def areplay(connection: AsyncReplayConnection) -> CodeBoxOutput:
+    client = AsyncKernelClient(connection)  # type: ignore
+    try:
+        return await client.execute("pass")
+    finally:
+        await client.close()
+
+
+def replay(mode: str, args: argparse.Namespace) -> Dict[str, float]:
+    """Replay the frames of an execution into the kernel client of a mode.
+
+    Measures deserializing, routing and collecting the messages up to the
+    output of the execution.
+    """
+    frames = replay_frames(args.replay)
+    samples = []
+    for iteration in range(args.warmup + args.iterations):
+        if mode == "sync":
+            connection: Any = ReplayConnection(frames)
+            output = KernelClient(connection).execute("pass")
+        else:
+            connection = AsyncReplayConnection(frames)
+            output = asyncio.run(areplay(connection))
+        elapsed = time.perf_counter() - connection.sent
+        check(output)
+        if iteration >= args.warmup:
+            samples.append(elapsed)
+    summary = summarize(samples)
+    summary["us_per_message"] = 1000 * summary["p50"] / args.replay
+    return summary
+
+
+def benchmark(
+    mode: str, new_box: Callable[[], DockerBox], args: argparse.Namespace
+) -> Dict[str, Dict[str, float]]:
+    """Run the iterations of one mode and summarize every stage."""
+    work = Workload(args)
+    samples: Samples = {}
+    for iteration in range(args.warmup + args.iterations):
+        # the warmup iterations pay for imports and first connections
+        target = samples if iteration >= args.warmup else {}
+        if mode == "sync":
+            run_sync(new_box(), work, target)
+        else:
+            asyncio.run(run_async(new_box(), work, target))
+    return {
+        stage: summarize(
+            values, args.file_size if stage in TRANSFER_STAGES else 0
+        )
+        for stage, values in samples.items()
+    }
+
+
+def report(results: Dict[str, Any]) -> str:
+    """Format the results as a table."""
+    lines = [f"{'mode':<6} {'stage':<14} {'p50':>9} {'p95':>9} {'p99':>9}  ms"]
+    for mode, stages in results.items():
+        for stage, summary in stages.items():
+            line = (
+                f"{mode:<6} {stage:<14} {summary['p50']:>9.2f} "
+                f"{summary['p95']:>9.2f} {summary['p99']:>9.2f}"
+            )
+            if "mb_per_s" in summary:
+                line += f"  {summary['mb_per_s']:.1f} MB/s"
+            if "us_per_message" in summary:
+                line += f"  {summary['us_per_message']:.2f} us/message"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--executes", type=int, default=20, help="trivial runs per iteration"
+    )
+    parser.add_argument("--stdout-size", type=int, default=1024 * 1024)
+    parser.add_argument("--image-size", type=int, default=1024 * 1024)
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument(
+        "--mode", choices=("sync", "async", "both"), default="both"
+    )
+    parser.add_argument(
+        "--docker", action="store_true", help="use real docker containers"
+    )
+    parser.add_argument(
+        "--replay",
+        type=int,
+        default=0,
+        help="only replay this many kernel messages into the clients",
+    )
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    docker_client = None if args.docker else FakeDockerClient()
+    modes = ("sync", "async") if args.mode == "both" else (args.mode,)
+    results = {
+        mode: (
+            {"replay": replay(mode, args)}
+            if args.replay
+            else benchmark(
+                mode, lambda: DockerBox(docker_client=docker_client), args
+            )
+        )
+        for mode in modes
+    }
+    print(report(results))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "created": datetime.now(timezone.utc).isoformat(),
+                    "gateway": (
+                        "replay"
+                        if args.replay
+                        else "docker"
+                        if args.docker
+                        else "fake"
+                    ),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "config": {
+                        key: value
+                        for key, value in vars(args).items()
+                        if key != "output"
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
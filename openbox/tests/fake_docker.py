@@ -0,0 +1,239 @@
+"""Fake docker client running fake kernel gateways instead of containers.
+
+``DockerBox(docker_client=FakeDockerClient())`` goes through the same client
+code paths as with docker: every container is a process of
+:mod:`openbox.tests.fake_gateway` and uploaded files are kept in memory.
+"""
+
+import io
+import os
+import queue
+import subprocess
+import sys
+import tarfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+import docker
+
+from openbox.box.utils import free_port
+
+GATEWAY_SCRIPT = os.path.join(os.path.dirname(__file__), "fake_gateway.py")
+# stands in for pip, "installs" the packages installed on the host only
+FAKE_PIP = (
+    "import sys; from importlib.metadata import version; "
+    "[version(package) for package in sys.argv[1:]]"
+)
+
+
+class FakeContainer:
+    """A fake kernel gateway process posing as a docker container.
+
+    Containers running ``pip install`` run a fake pip instead.
+    """
+
+    def __init__(
+        self, client: "FakeDockerClient", image: str, **kwargs: Any
+    ) -> None:
+        self.client = client
+        self.id = uuid4().hex
+        self.image = image
+        self.labels: Dict[str, str] = kwargs.get("labels") or {}
+        self.files: Dict[str, bytes] = {}
+        self.status = "running"
+        self.port = free_port()
+        command = kwargs.get("command") or []
+        if command[:2] == ["pip", "install"]:
+            packages = [arg for arg in command[2:] if not arg.startswith("-")]
+            self.process = subprocess.Popen(
+                [sys.executable, "-c", FAKE_PIP, *packages],
+                stderr=subprocess.DEVNULL,
+            )
+        else:
+            self.process = subprocess.Popen(
+                [sys.executable, GATEWAY_SCRIPT, "--port", str(self.port)]
+            )
+        self.attrs = {
+            "Id": self.id,
+            "State": {"Status": "running", "OOMKilled": False},
+            "Config": {"Labels": self.labels},
+            "NetworkSettings": {
+                "Ports": {
+                    port: [{"HostIp": "0.0.0.0", "HostPort": str(self.port)}]
+                    for port in kwargs.get("ports") or {}
+                }
+            },
+        }
+
+    def wait(self, **kwargs: Any) -> Dict[str, int]:
+        self.client.request()
+        return {"StatusCode": self.process.wait()}
+
+    def logs(self, **kwargs: Any) -> bytes:
+        return b""
+
+    def reload(self) -> None:
+        self.client.request()
+        if self.process.poll() is not None:
+            self.status = "exited"
+
+    def stop(self, **kwargs: Any) -> None:
+        self.client.request()
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.status = "exited"
+
+    def kill(self, **kwargs: Any) -> None:
+        self.stop()
+
+    def remove(self, force: bool = False, **kwargs: Any) -> None:
+        self.client.request()
+        if self.status == "running" and not force:
+            raise docker.errors.APIError("container is running")
+        self.stop()
+        self.client.containers.all.pop(self.id, None)
+
+    def put_archive(self, path: str, data: Iterator[bytes]) -> bool:
+        self.client.request()
+        archive = b"".join(data) if not isinstance(data, bytes) else data
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r|") as tar:
+            for info in tar:
+                if info.isfile():
+                    source = tar.extractfile(info)
+                    assert source is not None
+                    self.files[f"{path}/{info.name}"] = source.read()
+        return True
+
+    def get_archive(
+        self, path: str, chunk_size: int = 2 * 1024 * 1024, **kwargs: Any
+    ) -> Tuple[Iterator[bytes], Dict[str, Any]]:
+        self.client.request()
+        if path not in self.files:
+            raise docker.errors.NotFound(f"No such file: {path}")
+        content = self.files[path]
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo(path.rsplit("/", 1)[-1])
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        archive = buffer.getbuffer()
+        chunks = (
+            bytes(archive[start : start + chunk_size])
+            for start in range(0, len(archive), chunk_size)
+        )
+        return chunks, {"name": path, "size": len(content), "mode": 0o644}
+
+    def exec_run(self, cmd: List[str], **kwargs: Any) -> Any:
+        self.client.request()
+        output = b""
+        if cmd[0] == "ls":
+            output = "\n".join(
+                path.rsplit("/", 1)[-1] for path in self.files
+            ).encode()
+        elif cmd[0] == "find" and "-delete" in cmd:
+            self.files.clear()
+        return docker.models.containers.ExecResult(0, output)
+
+    def commit(self, repository: str, tag: str, **kwargs: Any) -> None:
+        self.client.request()
+        self.client.images.committed[f"{repository}:{tag}"] = self
+
+
+class FakeContainers:
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+        self.all: Dict[str, FakeContainer] = {}
+
+    def run(self, image: str, **kwargs: Any) -> FakeContainer:
+        self.client.request()
+        container = FakeContainer(self.client, image, **kwargs)
+        self.all[container.id] = container
+        return container
+
+    def get(self, container_id: str) -> FakeContainer:
+        self.client.request()
+        return self.all[container_id]
+
+    def list(
+        self, filters: Optional[Dict[str, str]] = None, **kwargs: Any
+    ) -> List[FakeContainer]:
+        self.client.request()
+        containers = list(self.all.values())
+        if filters and "label" in filters:
+            key, _, value = filters["label"].partition("=")
+            containers = [c for c in containers if c.labels.get(key) == value]
+        return containers
+
+
+class FakeImages:
+    """The images of the fake client, by tag the container they came from."""
+
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+        self.committed: Dict[str, FakeContainer] = {}
+
+    def get(self, name: str) -> SimpleNamespace:
+        self.client.request()
+        if ":pkgs-" in name and name not in self.committed:
+            raise docker.errors.ImageNotFound(name)
+        return SimpleNamespace(
+            tags=[name],
+            attrs={"Config": {"Cmd": ["jupyter", "kernelgateway"]}},
+        )
+
+    def remove(self, name: str, **kwargs: Any) -> None:
+        self.committed.pop(name, None)
+
+
+class FakeDockerClient:
+    """Docker client running fake kernel gateways instead of containers.
+
+    Container events like ``oom`` are made up with :meth:`emit`. Every API
+    call blocks for ``latency`` seconds, like a round trip to the daemon.
+    """
+
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+        self.containers = FakeContainers(self)
+        self.images = FakeImages(self)
+        self.api = SimpleNamespace(base_url=f"fake://{uuid4().hex}")
+        self._events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+
+    def request(self) -> None:
+        """Take as long as an API call to the docker daemon."""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def info(self) -> Dict[str, Any]:
+        self.request()
+        return {"NCPU": 1}
+
+    def events(self, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        self.request()
+        return self._follow_events()
+
+    def _follow_events(self) -> Iterator[Dict[str, Any]]:
+        while (event := self._events.get()) is not None:
+            yield event
+
+    def emit(self, action: str, container: FakeContainer) -> None:
+        """Send a container event to the events stream."""
+        self._events.put(
+            {
+                "Type": "container",
+                "Action": action,
+                "Actor": {"ID": container.id},
+            }
+        )
+
+    def close(self) -> None:
+        self._events.put(None)
+        for container in list(self.containers.all.values()):
+            container.remove(force=True)
@@ -0,0 +1,287 @@
+"""Fake jupyter kernel gateway for tests and benchmarks without docker.
+
+Speaks the REST and websocket protocol of the kernel gateway and executes
+the code with ``exec`` in its own process. Code can call
+``display_png(data)`` to send an image. Only depends on aiohttp so it starts
+quickly, run it with ``python openbox/tests/fake_gateway.py --port 8888``.
+"""
+
+import argparse
+import ast
+import asyncio
+import base64
+import ctypes
+import io
+import threading
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from aiohttp import WSMsgType, web
+
+
+def message(
+    msg_type: str,
+    parent: Dict[str, Any],
+    content: Dict[str, Any],
+    channel: str = "iopub",
+) -> Dict[str, Any]:
+    """Create a kernel message replying to the parent header."""
+    header = {
+        "msg_id": uuid4().hex,
+        "msg_type": msg_type,
+        "session": "fake",
+        "username": "fake",
+        "date": datetime.now(timezone.utc).isoformat(),
+        "version": "5.3",
+    }
+    return {
+        "header": header,
+        "msg_id": header["msg_id"],
+        "msg_type": msg_type,
+        "parent_header": parent,
+        "metadata": {},
+        "content": content,
+        "buffers": [],
+        "channel": channel,
+    }
+
+
+class FakeKernel:
+    """Executes code in a namespace, one execution at a time."""
+
+    def __init__(self) -> None:
+        self.id = str(uuid4())
+        self.execution_state = "idle"
+        self.namespace: Dict[str, Any] = {}
+        self._thread_id: Optional[int] = None
+
+    def model(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": "python3",
+            "execution_state": self.execution_state,
+            "last_activity": datetime.now(timezone.utc).isoformat(),
+            "connections": 1,
+        }
+
+    def execute(
+        self, code: str, parent: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        """Run code and return the messages a real kernel would send."""
+        outputs: List[Dict[str, Any]] = []
+        stdout, stderr = io.StringIO(), io.StringIO()
+
+        def display_png(data: bytes) -> None:
+            png = base64.b64encode(data).decode()
+            outputs.append(
+                message(
+                    "display_data",
+                    parent,
+                    {"data": {"image/png": png}, "metadata": {}},
+                )
+            )
+
+        self.namespace["display_png"] = display_png
+        self._thread_id = threading.get_ident()
+        error = None
+        try:
+            tree = ast.parse(code)
+            last = None
+            if tree.body and isinstance(tree.body[-1], ast.Expr):
+                last = ast.Expression(tree.body.pop().value)
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                exec(compile(tree, "<cell>", "exec"), self.namespace)
+                if last is not None:
+                    value = eval(
+                        compile(last, "<cell>", "eval"), self.namespace
+                    )
+                    if value is not None:
+                        outputs.append(
+                            message(
+                                "execute_result",
+                                parent,
+                                {
+                                    "data": {"text/plain": repr(value)},
+                                    "metadata": {},
+                                    "execution_count": 1,
+                                },
+                            )
+                        )
+        except BaseException as e:
+            error = e
+        finally:
+            self._thread_id = None
+
+        messages = [
+            message("stream", parent, {"name": name, "text": text})
+            for name, text in (
+                ("stdout", stdout.getvalue()),
+                ("stderr", stderr.getvalue()),
+            )
+            if text
+        ] + outputs
+        if error is not None:
+            messages.append(
+                message(
+                    "error",
+                    parent,
+                    {
+                        "ename": type(error).__name__,
+                        "evalue": str(error),
+                        "traceback": [],
+                    },
+                )
+            )
+        messages.append(
+            message(
+                "execute_reply",
+                parent,
+                {
+                    "status": "ok" if error is None else "error",
+                    "execution_count": 1,
+                },
+                channel="shell",
+            )
+        )
+        return messages
+
+    def interrupt(self) -> None:
+        """Raise KeyboardInterrupt in the running execution."""
+        if self._thread_id is not None:
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(self._thread_id),
+                ctypes.py_object(KeyboardInterrupt),
+            )
+
+
+class FakeGateway:
+    """The REST and websocket API of the kernel gateway."""
+
+    def __init__(self) -> None:
+        self.kernels: Dict[str, FakeKernel] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api", self.api)
+        app.router.add_get("/api/kernels", self.list_kernels)
+        app.router.add_post("/api/kernels", self.create_kernel)
+        app.router.add_get("/api/kernels/{id}", self.get_kernel)
+        app.router.add_delete("/api/kernels/{id}", self.delete_kernel)
+        app.router.add_post("/api/kernels/{id}/restart", self.restart)
+        app.router.add_post("/api/kernels/{id}/interrupt", self.interrupt)
+        app.router.add_get("/api/kernels/{id}/channels", self.channels)
+        return app
+
+    async def api(self, request: web.Request) -> web.Response:
+        return web.json_response({"version": "fake"})
+
+    async def list_kernels(self, request: web.Request) -> web.Response:
+        return web.json_response([k.model() for k in self.kernels.values()])
+
+    async def create_kernel(self, request: web.Request) -> web.Response:
+        kernel = FakeKernel()
+        self.kernels[kernel.id] = kernel
+        return web.json_response(kernel.model(), status=201)
+
+    async def get_kernel(self, request: web.Request) -> web.Response:
+        kernel = self._kernel(request)
+        return web.json_response(kernel.model())
+
+    async def delete_kernel(self, request: web.Request) -> web.Response:
+        self.kernels.pop(self._kernel(request).id)
+        return web.Response(status=204)
+
+    async def restart(self, request: web.Request) -> web.Response:
+        kernel = self._kernel(request)
+        kernel.namespace = {}
+        return web.json_response(kernel.model())
+
+    async def interrupt(self, request: web.Request) -> web.Response:
+        self._kernel(request).interrupt()
+        return web.Response(status=204)
+
+    async def channels(self, request: web.Request) -> web.WebSocketResponse:
+        kernel = self._kernel(request)
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        worker = asyncio.ensure_future(self._work(kernel, ws, queue))
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    await queue.put(msg.json())
+        finally:
+            worker.cancel()
+        return ws
+
+    async def _work(
+        self,
+        kernel: FakeKernel,
+        ws: web.WebSocketResponse,
+        queue: "asyncio.Queue[Dict[str, Any]]",
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            request = await queue.get()
+            parent = request["header"]
+            kernel.execution_state = "busy"
+            await ws.send_json(
+                message("status", parent, {"execution_state": "busy"})
+            )
+            messages = await loop.run_in_executor(
+                None, kernel.execute, request["content"]["code"], parent
+            )
+            for msg in messages:
+                await ws.send_json(msg)
+            kernel.execution_state = "idle"
+            await ws.send_json(
+                message("status", parent, {"execution_state": "idle"})
+            )
+            failed = messages[-1]["content"]["status"] == "error"
+            if failed and request["content"].get("stop_on_error", True):
+                await self._abort(ws, queue)
+
+    async def _abort(
+        self,
+        ws: web.WebSocketResponse,
+        queue: "asyncio.Queue[Dict[str, Any]]",
+    ) -> None:
+        """Skip the queued requests like ipykernel after an error."""
+        while not queue.empty():
+            parent = queue.get_nowait()["header"]
+            for msg in (
+                message("status", parent, {"execution_state": "busy"}),
+                message(
+                    "execute_reply",
+                    parent,
+                    {"status": "aborted"},
+                    channel="shell",
+                ),
+                message("status", parent, {"execution_state": "idle"}),
+            ):
+                await ws.send_json(msg)
+
+    def _kernel(self, request: web.Request) -> FakeKernel:
+        try:
+            return self.kernels[request.match_info["id"]]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+
+def serve(port: int) -> None:
+    """Run a fake kernel gateway on localhost:port until killed."""
+    web.run_app(
+        FakeGateway().app(),
+        host="127.0.0.1",
+        port=port,
+        print=None,
+        shutdown_timeout=0,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8888)
+    serve(parser.parse_args().port)
@@ -1,6 +1,20 @@
 import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
-from openbox import DockerBox
+from openbox import DockerBox, DockerBoxPool, SessionReaper, sessions
+from openbox.box.capture import OutputCapture
+from openbox.box.docker import package_image_tag
+from openbox.box.kernel import LAZY_CONTENT_SIZE, LazyMessage, deserialize
+from openbox.box.limits import limit_watcher
+from openbox.config import settings
+from openbox.tests.fake_docker import FakeDockerClient
 
 
 def test_DockerBox():
@@ -19,21 +33,490 @@ def test_localbox():
     ), "Failed to run async codebox locally"
 
 
+def test_DockerBoxPool():
+    with DockerBoxPool(min_size=1, max_size=2) as pool:
+        while not len(pool):
+            time.sleep(0.1)
+
+        codebox = DockerBox(pool=pool)
+        try:
+            assert codebox.start() == "started"
+            assert pool.hits == 1
+            assert codebox.run("print('Hello World!')") == "Hello World!\n"
+        finally:
+            assert codebox.stop() == "stopped"
+
+
+def test_multiple_sessions():
+    first, second = DockerBox(), DockerBox()
+    try:
+        assert first.start() == "started"
+        assert second.start() == "started"
+        assert sessions.get(first.session_id) is first
+        assert sessions.get(second.session_id) is second
+
+        first.run("name = 'first'")
+        second.run("name = 'second'")
+        assert first.run("print(name)") == "first\n"
+        assert second.run("print(name)") == "second\n"
+    finally:
+        first.stop()
+        second.stop()
+    assert first.session_id not in sessions
+
+
+def test_SessionReaper():
+    with DockerBoxPool(min_size=0, max_size=2) as pool:
+        first, second = DockerBox(pool=pool), DockerBox()
+        try:
+            assert first.start() == "started"
+            assert second.start() == "started"
+            first.run("secret = 42")
+
+            reaper = SessionReaper(idle_ttl=3600, max_sessions=1)
+            assert reaper.reap() == 1
+            assert second.session_id not in sessions
+            assert reaper.metrics["evicted"] == 1
+
+            reaper.idle_ttl = 0
+            assert reaper.reap() == 1
+            assert reaper.metrics["reaped"] == 1
+            assert first.container is None
+
+            third = DockerBox(pool=pool)
+            assert third.start() == "started"
+            assert third.run("secret").type == "error"
+            third.stop()
+        finally:
+            first.stop()
+            second.stop()
+
+
+def test_resource_limits():
+    codebox = DockerBox(mem_limit="256m", pids_limit=64)
+    try:
+        assert codebox.start() == "started"
+        host_config = codebox.container.attrs["HostConfig"]
+        assert host_config["Memory"] == 256 * 1024 * 1024
+        assert host_config["PidsLimit"] == 64
+
+        output = codebox.run("data = bytearray(1024 ** 3)")
+        assert output.type == "error"
+        assert "oom_killed" in output.events
+    finally:
+        codebox.stop()
+
+
+def test_fake_async_loop_lag():
+    # a docker call made on the loop blocks it for a whole round trip
+    latency = 0.05
+    docker_client = FakeDockerClient(latency=latency)
+    max_lag = 0.005
+    lags = []
+
+    async def monitor() -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(0.001)
+            lags.append(time.monotonic() - started - 0.001)
+
+    async def use_box() -> None:
+        task = asyncio.create_task(monitor())
+        codebox = DockerBox(docker_client=docker_client, mem_limit="256m")
+        try:
+            assert await codebox.astart() == "started"
+            assert await codebox.arun("print('Hello')") == "Hello\n"
+            await codebox.aupload("lag.txt", b"x" * 1024 * 1024)
+            assert len((await codebox.adownload("lag.txt")).content) > 0
+            assert await codebox.arestart() == "restarted"
+        finally:
+            assert await codebox.astop() == "stopped"
+            task.cancel()
+
+    # the first lookup of a process loads the resolver and stalls all threads
+    socket.getaddrinfo("localhost", None)
+    # threads working for the box hold the GIL for at most a switch interval
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(0.001)
+    try:
+        asyncio.run(use_box())
+    finally:
+        sys.setswitchinterval(interval)
+        docker_client.close()
+    lags.sort()
+    assert lags[-1] < latency, f"event loop blocked for {lags[-1]:.3f}s"
+    # the OS may still deschedule the whole process now and then
+    assert lags[len(lags) * 99 // 100] < max_lag
+
+
+def test_package_image():
+    assert package_image_tag(["pandas", "numpy"]) == package_image_tag(
+        ["NumPy", "pandas"]
+    )
+    assert package_image_tag(["pandas"]).startswith("codebox:pkgs-")
+
+    packages = ["tabulate"]
+    image = package_image_tag(packages)
+    codebox = DockerBox(packages=packages)
+    try:
+        assert codebox.start() == "started"
+        assert codebox.docker_client.images.get(image)
+        assert codebox.run("import tabulate").type != "error"
+    finally:
+        codebox.stop()
+        codebox.docker_client.images.remove(image)
+
+
+def test_lazy_message():
+    image = "iVBOR" + "A" * LAZY_CONTENT_SIZE
+    msg = {
+        "header": {"msg_type": "display_data"},
+        "parent_header": {"msg_id": 'a"b'},
+        "content": {"data": {"image/png": image}, "metadata": {}},
+        "buffers": [],
+    }
+    received_msg = deserialize(json.dumps(msg))
+    assert isinstance(received_msg, LazyMessage)
+    assert received_msg["parent_header"] == {"msg_id": 'a"b'}
+    assert received_msg["content"] == msg["content"]
+    assert deserialize(json.dumps(msg["parent_header"])) == {"msg_id": 'a"b'}
+
+
+def test_output_capture():
+    capture = OutputCapture(head=4, tail=4, spill=True)
+    for i in range(1000):
+        capture.write(f"{i:03}\n")
+    capture.close()
+    try:
+        assert capture.truncated
+        assert capture.summary() == "000\n[...]\n999\n"
+        with open(capture.log_file) as f:  # type: ignore
+            assert f.read() == "".join(f"{i:03}\n" for i in range(1000))
+    finally:
+        os.remove(capture.log_file)  # type: ignore
+
+    capture = OutputCapture(head=0, tail=500)
+    capture.write("Hello World!\n")
+    assert capture.summary() == "Hello World!\n"
+    assert not capture.truncated
+
+
+@contextmanager
+def fake_box(**kwargs) -> Iterator[DockerBox]:
+    """Start a DockerBox running a fake kernel gateway instead of docker."""
+    docker_client = FakeDockerClient()
+    codebox = DockerBox(docker_client=docker_client, **kwargs)
+    try:
+        assert codebox.start() == "started"
+        yield codebox
+    finally:
+        codebox.stop()
+        docker_client.close()
+
+
+def test_fake_reaper_pool():
+    docker_client = FakeDockerClient()
+    with DockerBoxPool(
+        min_size=1, max_size=1, docker_client=docker_client
+    ) as pool:
+        while not len(pool):
+            time.sleep(0.1)
+        first = DockerBox(pool=pool, docker_client=docker_client)
+        assert first.start() == "started"
+        used = first.container
+        first.run("secret = 42")
+
+        assert SessionReaper(idle_ttl=0).reap() == 1
+        # the container is removed instead of going back into the pool
+        assert used.id not in docker_client.containers.all
+        while not len(pool):
+            time.sleep(0.1)
+
+        second = DockerBox(pool=pool, docker_client=docker_client)
+        try:
+            assert second.start() == "started"
+            assert second.container is not used
+            assert second.run("secret").type == "error"
+        finally:
+            second.stop()
+    docker_client.close()
+
+
+def test_fake_reconnect():
+    with fake_box() as codebox:
+        session_id = codebox.session_id
+        codebox.run("x = 1")
+        codebox.ws.socket.shutdown(socket.SHUT_RDWR)  # type: ignore
+        assert codebox.run("print(x)") == "1\n"
+        assert codebox.session_id == session_id
+        assert len(sessions) == 1
+
+        # the kernel is gone, the session starts anew
+        codebox.http_session.delete(
+            f"{codebox.kernel_url}/kernels/{codebox.kernel_id}"
+        )
+        codebox.ws.socket.shutdown(socket.SHUT_RDWR)  # type: ignore
+        assert codebox.run("print('fresh')") == "fresh\n"
+        assert session_id not in sessions
+        assert codebox.session_id in sessions
+        assert len(sessions) == 1
+        assert len(codebox.docker_client.containers.all) == 1
+    assert len(sessions) == 0
+
+
+def test_fake_oom_killed():
+    with fake_box(mem_limit="256m") as codebox:
+        assert codebox.run("1").events == []
+        watcher = limit_watcher(codebox.docker_client)
+        codebox.docker_client.emit("oom", codebox.container)
+        deadline = time.monotonic() + 10
+        while not watcher.counters(codebox.container.id):
+            assert time.monotonic() < deadline, "oom event not seen"
+            time.sleep(0.01)
+        assert "oom_killed" in codebox.run("2").events
+        assert codebox.run("3").events == []
+
+
+def test_fake_oom_killed_async():
+    async def use_box() -> None:
+        docker_client = FakeDockerClient()
+        subscribe, subscribed = docker_client.events, []
+
+        def events(**kwargs):
+            subscribed.append(threading.current_thread())
+            return subscribe(**kwargs)
+
+        docker_client.events = events  # type: ignore
+        codebox = DockerBox(docker_client=docker_client, mem_limit="256m")
+        try:
+            assert await codebox.astart() == "started"
+            watcher = limit_watcher(docker_client)
+            docker_client.emit("oom", codebox.container)
+            deadline = time.monotonic() + 10
+            while not watcher.counters(codebox.container.id):
+                assert time.monotonic() < deadline, "oom event not seen"
+                await asyncio.sleep(0.01)
+            assert "oom_killed" in (await codebox.arun("1")).events
+            # the events stream is only followed on start, off the loop
+            assert len(subscribed) == 1
+            assert subscribed[0] is not threading.current_thread()
+        finally:
+            await codebox.astop()
+            docker_client.close()
+
+    asyncio.run(use_box())
+
+
+def test_fake_timeout():
+    with fake_box() as codebox:
+        started = time.monotonic()
+        assert codebox.run("while True: pass", timeout=1).type == "timeout"
+        assert time.monotonic() - started < 5
+        assert codebox.run("print('alive')") == "alive\n"
+
+
+def test_fake_run_many():
+    with fake_box() as codebox:
+        cells = ["y = 1", "1 / 0", "y = 2"]
+        outputs = codebox.run_many(cells, stop_on_error=False)
+        assert [o.type for o in outputs] == ["text", "error", "text"]
+        assert codebox.run("print(y)") == "2\n"
+
+        outputs = codebox.run_many(["y = 1", "1 / 0", "y = 3"])
+        assert [o.type for o in outputs] == ["text", "error", "aborted"]
+        # the code after the error never reached the kernel
+        assert codebox.run("print(y)") == "1\n"
+
+
+def test_fake_stream():
+    with fake_box() as codebox:
+        events = list(codebox.run_stream("print('Hello'); 1 + 1"))
+        assert [event.type for event in events] == ["stdout", "execute_result"]
+
+        types = []
+        for event in codebox.run_stream("print('outer'); 2"):
+            types.append(event.type)
+            # the box is not locked between the events
+            assert codebox.run("print('inner')") == "inner\n"
+        assert types == ["stdout", "execute_result"]
+
+        events = list(codebox.run_stream("while True: pass", timeout=1))
+        assert events[0].type == "timeout"
+
+
+def test_fake_astream():
+    async def stream() -> None:
+        docker_client = FakeDockerClient()
+        codebox = DockerBox(docker_client=docker_client)
+        try:
+            assert await codebox.astart() == "started"
+            events = [e async for e in codebox.arun_stream("print('Hello')")]
+            assert [event.type for event in events] == ["stdout"]
+            events = [
+                e
+                async for e in codebox.arun_stream(
+                    "while True: pass", timeout=1
+                )
+            ]
+            assert events[0].type == "timeout"
+            assert await codebox.arun("print('alive')") == "alive\n"
+        finally:
+            await codebox.astop()
+            docker_client.close()
+
+    asyncio.run(stream())
+
+
+def test_fake_restart():
+    with fake_box() as codebox:
+        for soft in (True, False):
+            codebox.run("x = 1")
+            assert codebox.restart(soft=soft) == "restarted"
+            assert codebox.run("print(x)").type == "error"
+
+
+def test_fake_arestart_pending():
+    async def restart_pending() -> None:
+        docker_client = FakeDockerClient()
+        codebox = DockerBox(docker_client=docker_client)
+        try:
+            assert await codebox.astart() == "started"
+            # the sleep ignores the interrupt, so the kernel is restarted
+            stuck, queued = await asyncio.gather(
+                codebox.arun("import time; time.sleep(3)", timeout=0.3),
+                codebox.arun("print('queued')"),
+            )
+            assert stuck.type == "timeout"
+            assert queued.type == "aborted"
+            assert await codebox.arun("print('alive')") == "alive\n"
+        finally:
+            await codebox.astop()
+            docker_client.close()
+
+    interrupt_timeout = settings.INTERRUPT_TIMEOUT
+    settings.INTERRUPT_TIMEOUT = 0.5
+    try:
+        asyncio.run(restart_pending())
+    finally:
+        settings.INTERRUPT_TIMEOUT = interrupt_timeout
+
+
+def test_fake_reaper():
+    with fake_box() as codebox:
+        reaper = SessionReaper(idle_ttl=0)
+        thread = threading.Thread(
+            target=codebox.run, args=("import time; time.sleep(2)",)
+        )
+        thread.start()
+        while not codebox.busy:
+            time.sleep(0.01)
+        assert reaper.reap() == 0
+        assert codebox.session_id in sessions
+
+        thread.join()
+        assert not codebox.busy
+        assert reaper.reap() == 1
+        assert codebox.session_id not in sessions
+
+
+def test_fake_pool_dead_container():
+    docker_client = FakeDockerClient()
+    with DockerBoxPool(
+        min_size=1, max_size=1, docker_client=docker_client
+    ) as pool:
+        while not len(pool):
+            time.sleep(0.1)
+        dead = list(docker_client.containers.all.values())
+        for container in dead:
+            container.process.kill()
+            container.process.wait()
+
+        codebox = DockerBox(pool=pool, docker_client=docker_client)
+        try:
+            assert codebox.start() == "started"
+            assert codebox.run("print('alive')") == "alive\n"
+            for container in dead:
+                assert container.id not in docker_client.containers.all
+        finally:
+            codebox.stop()
+    docker_client.close()
+
+
+def test_fake_package_image():
+    with fake_box() as codebox:
+        images = codebox.docker_client.images
+        codebox.upload("secret.txt", b"secret")
+        assert codebox.install_many(["pip"], commit=True) == {
+            "pip": "already installed"
+        }
+        # built in a fresh container, not committed from the session
+        source = images.committed[package_image_tag(["pip"])]
+        assert source is not codebox.container
+        assert not source.files
+        assert source.id not in codebox.docker_client.containers.all
+
+        packages = ["pip", "not-a-package-xyz"]
+        statuses = codebox.install_many(packages, commit=True)
+        assert statuses["not-a-package-xyz"] == "failed"
+        assert package_image_tag(packages) not in images.committed
+
+
 def run_sync(codebox: DockerBox) -> bool:
     try:
         assert codebox.start() == "started"
+        assert codebox.time_to_ready is not None
 
         assert codebox.status() == "running"
+        assert codebox.status(refresh=True) == "running"
 
         assert codebox.run("print('Hello World!')") == "Hello World!\n"
 
+        events = list(codebox.run_stream("print('Hello'); 1 + 1"))
+        assert [event.type for event in events] == ["stdout", "execute_result"]
+        assert events[1].content == "2"
+
+        for soft in (True, False):
+            codebox.run("x = 1")
+            assert codebox.restart(soft=soft) == "restarted"
+            assert codebox.run("print(x)").type == "error"
+
+        assert codebox.run("while True: pass", timeout=1).type == "timeout"
+        assert codebox.run("print('Hello World!')") == "Hello World!\n"
+
+        cells = ["y = 1", "1 / 0", "print(y + 1)"]
+        outputs = codebox.run_many(cells, stop_on_error=False)
+        assert [output.type for output in outputs] == ["text", "error", "text"]
+        assert outputs[2] == "2\n"
+        outputs = codebox.run_many(cells)
+        assert [o.type for o in outputs] == ["text", "error", "aborted"]
+
         file_name = "test_file.txt"
         assert file_name in str(codebox.upload(file_name, b"Hello World!"))
 
         assert codebox.download(file_name).content == b"Hello World!"
 
+        assert "2 files" in str(
+            codebox.upload_many({"a.txt": b"a", "b.txt": b"b"})
+        )
+        assert {"a.txt", "b.txt"} <= {f.name for f in codebox.list_files()}
+
+        progress = []
+        codebox.upload_stream(
+            "chunks.txt",
+            iter([b"Hello ", b"World!"]),
+            progress=lambda done, total: progress.append((done, total)),
+        )
+        assert progress[-1] == (12, 12)
+        assert b"".join(codebox.download_stream("chunks.txt")) == (
+            b"Hello World!"
+        )
+
         package_name = "matplotlib"
         assert package_name in str(codebox.install(package_name))
+        assert codebox.install_many(["matplotlib", "tabulate"]) == {
+            "matplotlib": "already installed",
+            "tabulate": "installed",
+        }
         assert (
             "error"
             != codebox.run(
@@ -43,9 +526,12 @@ def run_sync(codebox: DockerBox) -> bool:
 
         o = codebox.run(
             "import matplotlib.pyplot as plt;"
-            "plt.plot([1, 2, 3, 4], [1, 4, 2, 3]); plt.show()"
+            "plt.plot([1, 2, 3, 4], [1, 4, 2, 3]); plt.show();"
+            "plt.plot([4, 3, 2, 1]); plt.show()"
         )
         assert o.type == "image/png"
+        assert len(o.images) == 2
+        assert o.as_bytes().startswith(b"\x89PNG")
 
     finally:
         pass
@@ -59,9 +545,18 @@ async def run_async(codebox: DockerBox) -> bool:
         assert await codebox.astart() == "started"
 
         assert await codebox.astatus() == "running"
+        assert await codebox.astatus(refresh=True) == "running"
 
         assert await codebox.arun("print('Hello World!')") == "Hello World!\n"
 
+        first, second = await asyncio.gather(
+            codebox.arun("print('first')"), codebox.arun("print('second')")
+        )
+        assert (first, second) == ("first\n", "second\n")
+
+        outputs = await codebox.arun_many(["1 / 0", "print('skipped')"])
+        assert [o.type for o in outputs] == ["error", "aborted"]
+
         file_name = "test_file.txt"
         assert file_name in str(
             await codebox.aupload(file_name, b"Hello World!")